@@ -0,0 +1,346 @@
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from bson import ObjectId
+from decouple import config
+
+from src.models.device import Data, Device, SearchEntry
+from src.models.event import Event
+from src.models.live import LiveBucket
+
+base_url = config("benchmark_url", default="http://localhost:8080")
+details = f'mongodb://{config("mDBuser")}:{config("mDBpassword")}@{config("mDBurl")}:{config("mDBport")}/{config("mDBdatabase")}?authSource=admin'
+hostname_template = "benchmark_hostname_{}"
+
+
+def request(path: str, token: str = None, data: dict = None):
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    body = None
+    if data is not None:
+        body = json.dumps(data).encode("utf-8")
+
+    req = urllib.request.Request(base_url + path, data=body, headers=headers)
+    start_time = time.perf_counter()
+    with urllib.request.urlopen(req) as response:
+        content = response.read()
+    return time.perf_counter() - start_time, content
+
+
+def login():
+    _, content = request("/api/login", data={"password": config("pw"), "id": 1, "name": "benchmark"})
+    return json.loads(content)["access_token"]
+
+
+def percentile(values: list, p: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def load_test(duration: int = 30, heavy_clients: int = 4, cheap_clients: int = 16):
+    """
+    Mixed endpoint load test: heavy clients hammer /api/devices/all while cheap clients poll /api/categories.
+    With non-blocking database access the p99 of the cheap route should stay flat.
+    """
+    token = login()
+    latencies = {"/api/categories": [], "/api/devices/all": []}
+    stop = time.time() + duration
+
+    def client(path):
+        while time.time() < stop:
+            latency, _ = request(path, token=token)
+            latencies[path].append(latency)
+
+    threads = [threading.Thread(target=client, args=("/api/devices/all",)) for _ in range(heavy_clients)]
+    threads += [threading.Thread(target=client, args=("/api/categories",)) for _ in range(cheap_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for path, values in latencies.items():
+        if values:
+            print(f"{path}: {len(values)} requests, p50 {percentile(values, 0.5) * 1000:.1f} ms, "
+                  f"p99 {percentile(values, 0.99) * 1000:.1f} ms")
+
+
+def get_mongo():
+    from src.mongoDBIO import MongoDBIO
+    return MongoDBIO(details)
+
+
+def seed_devices(mongo, count: int, ports: int = 24):
+    category = mongo.get_category_by_category("Benchmark")
+    if category is None:
+        category = mongo.add_category(category="Benchmark")
+
+    data = []
+    devices = []
+    for i in range(0, count):
+        interfaces = {}
+        for port in range(0, ports):
+            interfaces[f"GigabitEthernet{port}"] = {"index": str(port), "admin_status": "up",
+                                                    "description": f"GigabitEthernet{port}"}
+        system = Data(key="system", data={"system": {"name": hostname_template.format(i)}}).to_son()
+        system["_id"] = ObjectId()
+        network = Data(key="network_interfaces", data=interfaces).to_son()
+        network["_id"] = ObjectId()
+        data.extend([system, network])
+
+        device = Device(hostname=hostname_template.format(i), ip=f"10.0.{i // 256}.{i % 256}",
+                        category=category).to_son()
+        device["static"] = [system["_id"], network["_id"]]
+        devices.append(device)
+
+    Data._mongometa.collection.insert_many(data)
+    Device._mongometa.collection.insert_many(devices)
+
+
+def clear_devices():
+    devices = list(Device._mongometa.collection.find({"hostname": {"$regex": "^benchmark_hostname_"}}))
+    ids = []
+    for device in devices:
+        ids.extend(device.get("static", []))
+        ids.extend(device.get("live", []))
+    Data._mongometa.collection.delete_many({"_id": {"$in": ids}})
+    SearchEntry._mongometa.collection.delete_many({"data": {"$in": ids}})
+    LiveBucket._mongometa.collection.delete_many({"device": {"$in": [device["_id"] for device in devices]}})
+    Device._mongometa.collection.delete_many({"_id": {"$in": [device["_id"] for device in devices]}})
+
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start_time
+
+
+def devices_full(counts: tuple = (1000, 10000)):
+    """
+    Compares the $lookup pipeline of get_device_by_category_full with the previous per-document implementation
+    """
+    mongo = get_mongo()
+    for count in counts:
+        clear_devices()
+        seed_devices(mongo, count)
+        legacy = timed(mongo.get_device_by_category_full_legacy)
+        pipeline = timed(mongo.get_device_by_category_full)
+        print(f"{count} devices: legacy {legacy:.2f} s, pipeline {pipeline:.2f} s")
+    clear_devices()
+
+
+def events_pagination(amount: int = 25, deep_page: int = 10000):
+    """
+    Compares skip/limit paging with keyset paging (after=<ObjectId>) for page 1 and a deep page of the alert list
+    """
+    mongo = get_mongo()
+    clear_devices()
+    seed_devices(mongo, 1)
+    device = Device.objects.get({"hostname": hostname_template.format(0)})
+
+    events = []
+    for i in range(0, amount * deep_page):
+        events.append(Event(device=device, severity=i % 11, event=f"benchmark event {i}",
+                            timestamp="2022-01-01 00:00:00").to_son())
+        if len(events) == 10000:
+            Event._mongometa.collection.insert_many(events)
+            events = []
+    if events:
+        Event._mongometa.collection.insert_many(events)
+
+    cursor = mongo.get_events(amount=1, page=amount * (deep_page - 1))[0]["id"]
+    print(f"page 1: skip {timed(mongo.get_events, amount=amount, page=1):.4f} s")
+    print(f"page {deep_page}: skip {timed(mongo.get_events, amount=amount, page=deep_page):.4f} s, "
+          f"keyset {timed(mongo.get_events, amount=amount, after=cursor):.4f} s")
+
+    Event._mongometa.collection.delete_many({"device": device.pk})
+    clear_devices()
+
+
+def filter_devices(count: int = 10000, amount: int = 25):
+    """
+    Compares the $objectToArray/$regex filter pipelines with the SearchEntry index for exact, prefix and substring
+    matches on interface descriptions
+    """
+    mongo = get_mongo()
+    clear_devices()
+    seed_devices(mongo, count)
+    print(f"search index backfill: {timed(mongo.rebuild_search_index):.2f} s")
+
+    print(f"legacy: {timed(mongo.filter_devices_legacy, 'description', 'GigabitEthernet1', 1, amount):.4f} s")
+    for match in ["exact", "prefix", "substring"]:
+        duration = timed(mongo.filter_devices, 'description', 'GigabitEthernet1', 1, amount, None, match)
+        print(f"{match}: {duration:.4f} s")
+    clear_devices()
+
+
+def build_report(count: int, ports: int = 48):
+    devices = []
+    for i in range(0, count):
+        hostname = hostname_template.format(i)
+        interfaces = {}
+        neighbors = {}
+        for port in range(0, ports):
+            mac = f"00:00:00:{i % 256:02x}:00:{port:02x}"
+            remote_mac = f"00:00:00:{(i + 1) % 256:02x}:00:{port:02x}"
+            interfaces[f"GigabitEthernet{port}"] = {"index": str(port), "admin_status": "up", "oper_status": "up",
+                                                    "speed": "1000", "mac_address": mac,
+                                                    "description": f"GigabitEthernet{port}"}
+            neighbors[f"GigabitEthernet{port}"] = [{"local_port": f"GigabitEthernet{port}", "local_mac": mac,
+                                                    "remote_chassis_id": remote_mac}]
+        devices.append({"name": hostname, "ip": f"10.0.{i // 256}.{i % 256}",
+                        "static_data": {"system": {"name": hostname}, "interfaces": interfaces, "neighbors": neighbors},
+                        "events": [{"information": f"benchmark event {i}", "severity": 3,
+                                    "timestamp": "2022-01-01 00:00:00"}]})
+    return {"devices": devices, "external_events": {}}
+
+
+def ingest_payload(count: int = 2000):
+    """
+    Bytes over the wire per encoding and peak RSS of decoding one report, pydantic over json.loads compared with the
+    streaming IngestPayload decoder. Every decode runs in its own process, so its peak RSS is the peak of that decode.
+    """
+    import msgpack
+    import zstandard
+
+    report = build_report(int(count))
+    raw_json = json.dumps(report).encode("utf-8")
+    raw_msgpack = msgpack.packb(report)
+    del report
+
+    directory = tempfile.mkdtemp()
+    variants = [
+        ("pydantic", "report.json", raw_json, "application/json", "identity"),
+        ("stream", "report.json", raw_json, "application/json", "identity"),
+        ("stream", "report.json.gz", gzip.compress(raw_json), "application/json", "gzip"),
+        ("stream", "report.json.zst", zstandard.ZstdCompressor().compress(raw_json), "application/json", "zstd"),
+        ("stream", "report.msgpack", raw_msgpack, "application/msgpack", "identity"),
+        ("stream", "report.msgpack.zst", zstandard.ZstdCompressor().compress(raw_msgpack), "application/msgpack",
+         "zstd"),
+    ]
+    for mode, name, content, content_type, encoding in variants:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            with open(path, "wb") as file:
+                file.write(content)
+        print(f"{name}: {len(content) / 1024 / 1024:.2f} MB on the wire")
+        subprocess.run([sys.executable, __file__, "ingest_rss", mode, path, content_type, encoding], check=True)
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+def peak_rss():
+    # ru_maxrss survives exec and would report the parent's peak, VmHWM starts over with the new process image
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def ingest_rss(mode: str, path: str, content_type: str, encoding: str):
+    from src.ingestPayload import IngestPayload
+    from src.models.models import AddDataForDevices
+
+    baseline = peak_rss()
+    start_time = time.perf_counter()
+    devices = 0
+    if mode == "pydantic":
+        with open(path, "rb") as file:
+            devices = len(AddDataForDevices(**json.loads(file.read())).devices)
+    else:
+        payload = IngestPayload(content_type, encoding)
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                payload.feed(chunk)
+        payload.finish()
+        for batch, _ in payload.batches():
+            devices += len(batch)
+        payload.close()
+
+    peak = peak_rss()
+    print(f"    {mode} {encoding}: {devices} devices in {time.perf_counter() - start_time:.2f} s, "
+          f"peak RSS +{(peak - baseline) / 1024:.1f} MB")
+
+
+def live_rollup(count: int = 1000, ports: int = 24, samples: int = 30):
+    """
+    Rolls up samples of every counter for count devices with ports ports each, as collected by Redis in one window
+    """
+    count, ports, samples = int(count), int(ports), int(samples)
+    mongo = get_mongo()
+    clear_devices()
+    seed_devices(mongo, count, ports)
+
+    now = time.time()
+    for i in range(0, count):
+        live_data = {}
+        for port in range(0, ports):
+            live_data[f"GigabitEthernet{port}"] = {
+                index: {str(now + sample * 60): float((i + port + sample) % 97) for sample in range(0, samples)}
+                for index in mongo.redis_indices}
+        mongo.redis_insert_live_data(Device(hostname=hostname_template.format(i)), live_data)
+
+    total = count * ports * samples * len(mongo.redis_indices)
+    duration = mongo.insert_live_data_into_database()
+    print(f"rollup of {total} samples: {duration:.2f} s, {total / duration:.0f} samples/s")
+    clear_devices()
+
+
+def export_devices(count: int = 10000):
+    """
+    Peak RSS of returning every device through get_device_by_category_full and of streaming them with
+    export_devices, each in its own process
+    """
+    mongo = get_mongo()
+    clear_devices()
+    seed_devices(mongo, int(count))
+    for mode in ["full", "export"]:
+        subprocess.run([sys.executable, __file__, "export_rss", mode], check=True)
+    clear_devices()
+
+
+def export_rss(mode: str):
+    from src.models.models import GetAllDevicesOut
+
+    mongo = get_mongo()
+    baseline = peak_rss()
+    start_time = time.perf_counter()
+    size = 0
+    if mode == "full":
+        result = mongo.get_device_by_category_full()
+        size = len(GetAllDevicesOut(total=result["total"], devices=result["devices"]).json())
+    else:
+        for batch in mongo.export_devices():
+            size += sum(len(json.dumps(device, default=str)) + 1 for device in batch)
+
+    peak = peak_rss()
+    print(f"    {mode}: {size / 1024 / 1024:.1f} MB in {time.perf_counter() - start_time:.2f} s, "
+          f"peak RSS +{(peak - baseline) / 1024:.1f} MB")
+
+
+benchmarks = {
+    "load": load_test,
+    "devices_full": devices_full,
+    "events_pagination": events_pagination,
+    "filter_devices": filter_devices,
+    "ingest_payload": ingest_payload,
+    "ingest_rss": ingest_rss,
+    "live_rollup": live_rollup,
+    "export_devices": export_devices,
+    "export_rss": export_rss,
+}
+
+if __name__ == "__main__":
+    benchmarks[sys.argv[1] if len(sys.argv) > 1 else "load"](*sys.argv[2:])
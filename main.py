@@ -1,18 +1,22 @@
+import argparse
 import asyncio
 import ssl
+import sys
 
 import pymongo.errors
+from decouple import config
 
 from src.api import app, mongo
-from src.mongoDBIO import MongoDBIO
+from src.indexAdvisor import IndexAdvisor
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
+from hypercorn.run import run as run_workers
 
 
 async def main(config):
-    await asyncio.gather(serve(app, config), MongoDBIO.thread_insertIntoDatabase(mongo), MongoDBIO.keep_connections(mongo))
+    await asyncio.gather(serve(app, config), mongo.run_background_jobs())
 
-def run():
+def get_config():
     cfg = Config()
     cfg.bind = ["0.0.0.0:8443"]
     cfg.insecure_bind = ["0.0.0.0:8080"]
@@ -21,12 +25,106 @@ def run():
     cfg.worker_class = 'asyncio'
     cfg.accesslog = "-"
     cfg.loglevel = "DEBUG"
+    return cfg
 
-    asyncio.run(main(cfg))
+def run(workers: int = 1):
+    cfg = get_config()
+    if workers > 1:
+        # Every worker process imports the app on its own, background jobs run in "python main.py worker"
+        cfg.application_path = "src.api:app"
+        cfg.workers = workers
+        run_workers(cfg)
+    else:
+        asyncio.run(main(cfg))
+
+def worker():
+    asyncio.run(mongo.run_background_jobs())
+
+def advise_indexes():
+    collscans = IndexAdvisor().print_report()
+    sys.exit(1 if collscans else 0)
+
+def reconcile_event_counts():
+    buckets = mongo.reconcile_event_counts()
+    print(f"Rebuilt {buckets} event count buckets")
+    sys.exit(0)
+
+def rebuild_connections():
+    created = mongo.build_connections(full=True)
+    print(f"Created {created} connections")
+    sys.exit(0)
+
+def rebuild_search_index():
+    entries = mongo.rebuild_search_index()
+    print(f"Indexed {entries} static data values")
+    sys.exit(0)
+
+def migrate_live_history():
+    moved = mongo.migrate_live_history()
+    print(f"Moved {moved} live data entries into live buckets")
+    sys.exit(0)
+
+def apply_retention(dry_run: bool):
+    mongo.print_retention_report(mongo.apply_retention(dry_run=dry_run), dry_run=dry_run)
+    sys.exit(0)
+
+def archive_events():
+    stamped = mongo.stamp_event_expiry()
+    result = mongo.archive_expired_events()
+    print(f"Set the expiry of {stamped} events, archived {result['archived']} expired events to {result['file']}")
+    sys.exit(0)
+
+def restamp_events():
+    stamped = mongo.stamp_event_expiry(restamp=True)
+    print(f"Set the expiry of {stamped} events")
+    sys.exit(0)
+
+def restore_events(path: str):
+    if path is None:
+        print("restore-events needs the archive file or directory")
+        sys.exit(2)
+    result = mongo.restore_events(path)
+    print(f"Restored {result['restored']} events, {result['present']} were present, "
+          f"{result['skipped']} belonged to deleted devices")
+    sys.exit(0)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NetAPI")
+    parser.add_argument("command", nargs="?", default="serve",
+                        choices=["serve", "worker", "advise-indexes", "reconcile-event-counts", "rebuild-connections",
+                                 "rebuild-search-index", "migrate-live-history", "apply-retention", "archive-events",
+                                 "restamp-events", "restore-events"])
+    parser.add_argument("path", nargs="?", help="archive file or directory for restore-events")
+    parser.add_argument("--workers", type=int, default=config("workers", cast=int, default=1),
+                        help="number of HTTP worker processes, background jobs then need a separate worker command")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="apply-retention only reports what it would compact and reclaim")
+    args = parser.parse_args()
+
+    if args.command == "advise-indexes":
+        advise_indexes()
+    elif args.command == "reconcile-event-counts":
+        reconcile_event_counts()
+    elif args.command == "rebuild-connections":
+        rebuild_connections()
+    elif args.command == "rebuild-search-index":
+        rebuild_search_index()
+    elif args.command == "migrate-live-history":
+        migrate_live_history()
+    elif args.command == "apply-retention":
+        apply_retention(args.dry_run)
+    elif args.command == "archive-events":
+        archive_events()
+    elif args.command == "restamp-events":
+        restamp_events()
+    elif args.command == "restore-events":
+        restore_events(args.path)
+
     while True:
         try:
-            run()
+            if args.command == "worker":
+                worker()
+            else:
+                run(args.workers)
         except (pymongo.errors.ServerSelectionTimeoutError, TimeoutError, asyncio.exceptions.CancelledError, ssl.SSLError, OSError):
             print("Lost connection to DB! Restarting")
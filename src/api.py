@@ -1,10 +1,14 @@
+import asyncio
+import csv
 import inspect
+import io
 import json
 import re
+from collections import deque
 from fastapi.routing import APIRoute
-from fastapi import FastAPI, Depends, Request, HTTPException
+from fastapi import FastAPI, Depends, Request, Response, HTTPException, WebSocket
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi_jwt_auth.exceptions import AuthJWTException
 from starlette.middleware.cors import CORSMiddleware
 from fastapi_jwt_auth import AuthJWT
@@ -18,13 +22,18 @@ from bson import ObjectId
 from src.models.node import TreeJson
 from src.crypt import Crypt
 from src.mongoDBIO import MongoDBIO
+from src.asyncMongoDBIO import AsyncMongoDBIO
+from src.broker import Broker, EVENTS_CHANNEL, LIVE_CHANNEL
+from src.ingestQueue import IngestQueue
+from src.ingestPayload import IngestPayload, PayloadError
+from src.indexAdvisor import IndexAdvisor
 from src.models.models import Settings, ServiceLoginOut, ServiceAggregatorLoginOut, ServiceLogin, \
     ServiceAggregatorLogin, AddAggregatorIn, AddAggregatorOut, APIStatus, DeviceByIdIn, GetAllDevicesOut, \
     AggregatorByID, SetConfig, LinkAgDeviceIN, AggregatorDeviceLinkOut, AggregatorsOut, \
     AddDataForDevices, AggregatorVersionIn, AggregatorVersionOut, AggregatorModulesIn, AggregatorModulesOut, \
     DeviceByIdOut, AddDeviceIn, AddDeviceOut, AddCategoryIn, AddCategoryOut, GetAlertByIdOut, AddDataForDeviceOut, \
     GetAlertsByIdIn, GetAllAlertsOut, GetCategoriesOut, FilterOut, DevicesFilterOut, DeviceConfigOut, DeleteConfig, \
-    UpdateDevice, UpdateCategory
+    UpdateDevice, UpdateCategory, LiveDataOut
 
 # Note: Better logging if needed
 # logging.config.fileConfig('loggingx.conf', disable_existing_loggers=False)
@@ -41,7 +50,16 @@ crypt = Crypt()
 mongo = MongoDBIO(
     details=f'mongodb://{config("mDBuser")}:{config("mDBpassword")}@{config("mDBurl")}:{config("mDBport")}/{config("mDBdatabase")}?authSource=admin')
 
-mongo.first_start()
+db = AsyncMongoDBIO(mongo)
+
+broker = Broker([EVENTS_CHANNEL, LIVE_CHANNEL])
+
+ingest_queue = None
+ingest_consumers = []
+if config("ingest_queue", cast=bool, default=False):
+    ingest_queue = IngestQueue(config("ingest_queue_path", default="./ingest_queue.sqlite3"),
+                               max_size=config("ingest_queue_size", cast=int, default=10000),
+                               max_attempts=config("ingest_max_attempts", cast=int, default=5))
 
 origins = [
     "http://localhost:4200",
@@ -92,6 +110,17 @@ def custom_openapi():
     else:
         openapi_schema["components"] = {"securitySchemes": cookie_security_schemes}
 
+    # /devices/data reads its body as a stream, document the payload it accepts
+    if "/api/devices/data" in openapi_schema["paths"]:
+        schema = AddDataForDevices.schema()
+        openapi_schema["paths"]["/api/devices/data"]["post"]["requestBody"] = {
+            "required": True,
+            "content": {
+                "application/json": {"schema": schema},
+                "application/msgpack": {"schema": schema}
+            }
+        }
+
     api_router = [route for route in app.routes if isinstance(route, APIRoute)]
 
     for route in api_router:
@@ -136,6 +165,59 @@ async def root() -> APIStatus:
     return APIStatus(version=version, uptime=output_time)
 
 
+@app.on_event("startup")
+async def startup():
+    # Runs in every worker process, the lease keeps concurrently starting workers from seeding twice
+    if await db.acquire_lease("first-start", 60):
+        try:
+            await db.first_start()
+        finally:
+            await db.release_lease("first-start")
+
+    if config("index_advisor", cast=bool, default=False):
+        await db.run(IndexAdvisor().print_report)
+
+    broker.start(asyncio.get_running_loop(), mongo.__get_redis__(0))
+
+    if ingest_queue is not None:
+        # Payloads accepted before a crash are still in the queue file and are drained first
+        for _ in range(0, config("ingest_consumers", cast=int, default=2)):
+            ingest_consumers.append(asyncio.ensure_future(
+                ingest_queue.consume(db, batch_size=config("ingest_batch_size", cast=int, default=10))))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for consumer in ingest_consumers:
+        consumer.cancel()
+    if ingest_consumers:
+        await asyncio.gather(*ingest_consumers, return_exceptions=True)
+    if ingest_queue is not None:
+        ingest_queue.close()
+
+    broker.stop()
+    db.shutdown()
+    mongo.close()
+
+
+@app.get("/api/metrics", tags=["Metrics"])
+async def get_metrics(authorize: AuthJWT = Depends()):
+    """
+    /metrics - GET - returns internal counters of the database access layer
+    """
+    authorize.jwt_required()
+
+    return JSONResponse(status_code=200, content={
+        "executor": db.get_executor_metrics(),
+        "redis": mongo.get_redis_metrics(),
+        "cache": mongo.get_cache_metrics(),
+        "writes": mongo.get_write_metrics(),
+        "broker": broker.get_metrics(),
+        "rollup": mongo.get_rollup_metrics(),
+        "ingest_queue": await db.run(ingest_queue.get_metrics) if ingest_queue is not None else None
+    })
+
+
 # --- AUTHENTICATION--- #
 
 @app.post('/api/login', response_model=ServiceLoginOut, tags=["Authentication"])
@@ -194,7 +276,7 @@ async def aggregator_login(request: ServiceAggregatorLogin, authorize: AuthJWT =
     except KeyError:
         raise HTTPException(status_code=400, detail=BAD_PARAM)
 
-    exists = mongo.check_token(token)
+    exists = await db.check_token(token)
 
     if exists:
         aggregator_id = str(exists.pk)
@@ -245,7 +327,7 @@ async def add_aggregator(request: AddAggregatorIn, authorize: AuthJWT = Depends(
         raise HTTPException(status_code=400, detail=BAD_PARAM)
 
     try:
-        mongo.add_aggregator(token, identifier)
+        await db.add_aggregator(token, identifier)
     except pymongo.errors.DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Already exists")
 
@@ -253,72 +335,24 @@ async def add_aggregator(request: AddAggregatorIn, authorize: AuthJWT = Depends(
 
 
 @app.get("/api/aggregator/{id}", response_model=AggregatorByID, tags=["Aggregator"])
-async def get_aggregator_by_id(id: str = "", authorize: AuthJWT = Depends()):
+async def get_aggregator_by_id(request: Request, response: Response, id: str = "", authorize: AuthJWT = Depends()):
     """
     /aggregator/{id} - GET - returns devices belonging to the aggregator
     """
     authorize.jwt_required()
 
-    if id == "":
+    if id == "" or not ObjectId.is_valid(id):
         raise HTTPException(status_code=400, detail=BAD_PARAM)
 
-    id = ObjectId(id)
+    # Aggregators poll this route, answer unchanged configs with one read of the shared config version
+    version = await db.get_config_version()
+    etag = mongo.get_aggregator_config_etag(id, version)
+    if etag is not None and request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
 
-    db_result = mongo.get_aggregator_devices(id)
-    try:
-        version = db_result.version
-        if version == None:
-            version = ""
-    except AttributeError:
-        version = ""
-    try:
-        ip = db_result.ip
-    except AttributeError:
-        ip = ""
-    try:
-        devices = db_result.devices
-    except AttributeError:
-        devices = []
-
-    devs = []
-    for d in devices:
-
-        d = d.to_son().to_dict()
-        d["id"] = str(d.pop("_id"))
-        if "category" in d:
-            category = mongo.get_category_by_id(d.pop("category"))
-            if category:
-                category = category.category
-                # This has to be named typed. IDK why but just let it be
-                d["type"] = category
-        d["timeout"] = 10
-
-        if "static" in d:
-            d.pop("static")
-
-        if "live" in d:
-            d.pop("live")
-
-
-        id = ObjectId(str(d["id"]))
-        query_result = mongo.get_device_config(id)
-        configs = []
-        if not False:
-            for c in query_result:
-                name = c.type.type
-                if c.config is None:
-                    c.config = []
-                c = c.to_son().to_dict()
-                id_ = c["_id"]
-                c["id"] = str(id_)
-                c.pop("_id")
-                c["name"] = name
-                c.pop("type")
-                configs.append(c)
-            d["modules"] = configs
-
-        devs.append(d)
-    return AggregatorByID(version=version, ip=ip, devices=devs)
+    config = await db.get_aggregator_config(id)
+    response.headers["ETag"] = mongo.set_aggregator_config_etag(id, config, version)
+    return AggregatorByID(**config)
 
 
 @app.post("/api/aggregator/{id}/version", response_model=AggregatorVersionOut, tags=["Aggregator"])
@@ -334,7 +368,7 @@ async def get_aggregator_version_by_id(request: AggregatorVersionIn, id: str = "
             raise HTTPException(status_code=400, detail=BAD_PARAM)
 
         id = ObjectId(id)
-        mongo.set_aggregator_version(id, ver)
+        await db.set_aggregator_version(id, ver)
         return AggregatorVersionOut(detail="Updated")
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
@@ -353,7 +387,7 @@ async def aggregator_modules(request: AggregatorModulesIn, id: str = "", authori
             raise HTTPException(status_code=400, detail=BAD_PARAM)
 
         id = ObjectId(id)
-        mongo.insert_aggregator_modules(modules, id)
+        await db.insert_aggregator_modules(modules, id)
         return AggregatorModulesOut(detail="Inserted")
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
@@ -365,7 +399,7 @@ async def get_aggregators(authorize: AuthJWT = Depends()):
     """
     authorize.jwt_required()
 
-    ags = mongo.get_aggregators()
+    ags = await db.get_aggregators()
 
     return AggregatorsOut(aggregators=ags)
 
@@ -383,7 +417,7 @@ async def link_device_to_aggregator(request: LinkAgDeviceIN, authorize: AuthJWT
     except KeyError:
         raise HTTPException(status_code=400, detail=BAD_PARAM)
 
-    db_result = mongo.set_aggregator_device(ag, dev)
+    db_result = await db.set_aggregator_device(ag, dev)
 
     if not db_result or db_result == -1:
         raise HTTPException(status_code=400, detail=BAD_PARAM)
@@ -397,6 +431,7 @@ async def get_devices_by_category_full(
         category: Optional[str] = None,
         page: Optional[int] = None,
         amount: Optional[int] = None,
+        after: Optional[str] = None,
         authorize: AuthJWT = Depends()
 ):
     """
@@ -414,10 +449,14 @@ async def get_devices_by_category_full(
         if category:
             categories.append(ObjectId(category))
 
-    result = mongo.get_device_by_category_full(categories=categories, page=page, amount=amount)
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    result = await db.get_device_by_category_full(categories=categories, page=page, amount=amount, after=after)
     if result == -1 or result is False:
         raise HTTPException(status_code=400, detail="Error occurred")
-    return GetAllDevicesOut(page=page, amount=amount, total=result["total"], devices=result["devices"])
+    return GetAllDevicesOut(page=page, amount=amount, total=result["total"], devices=result["devices"],
+                            next_cursor=result["next_cursor"])
 
 
 @app.get("/api/devices", response_model=GetAllDevicesOut, tags=["Device"])
@@ -425,6 +464,7 @@ async def get_devices_by_category(
         category: Optional[str] = None,
         page: Optional[int] = None,
         amount: Optional[int] = None,
+        after: Optional[str] = None,
         authorize: AuthJWT = Depends()
 ):
     """
@@ -442,34 +482,201 @@ async def get_devices_by_category(
         if category:
             categories.append(ObjectId(category))
 
-    result = mongo.get_device_by_category(categories=categories, page=page, amount=amount)
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    result = await db.get_device_by_category(categories=categories, page=page, amount=amount, after=after)
     if result == -1 or result is False:
         raise HTTPException(status_code=400, detail="Error occurred")
-    return GetAllDevicesOut(page=page, amount=amount, total=result["total"], devices=result["devices"])
+    return GetAllDevicesOut(page=page, amount=amount, total=result["total"], devices=result["devices"],
+                            next_cursor=result["next_cursor"])
+
+
+def local_time(value: Optional[datetime.datetime]):
+    """
+    Converts a query datetime with an offset ("...Z", "+02:00") to the naive local time live history is stored in
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
 
 
 @app.get("/api/devices/{id}", response_model=DeviceByIdOut, tags=["Device"])
-async def device_by_id(id: str, authorize: AuthJWT = Depends()):
+async def device_by_id(id: str,
+                       start: Optional[datetime.datetime] = None,
+                       end: Optional[datetime.datetime] = None,
+                       step: Optional[int] = None,
+                       authorize: AuthJWT = Depends()):
     """
-    /devices/{id} - GET - returns device infos with specified id
+    /devices/{id} - GET - returns device infos with specified id, with start or end also the live counter history
     """
     authorize.jwt_required()
 
-    device = mongo.get_device_by_id(id)
+    if step is not None and step <= 0:
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    device = await db.get_device_by_id(id, start=local_time(start), end=local_time(end), step=step)
 
     return DeviceByIdOut(device=device)
 
 
-@app.post("/api/devices/data", response_model=AddDataForDeviceOut, tags=["Device"])
-async def devices_data(request: AddDataForDevices, authorize: AuthJWT = Depends()):
+@app.get("/api/devices/{id}/live", response_model=LiveDataOut, tags=["Device"])
+async def get_live_data_by_device(
+        id: str,
+        counter: Optional[str] = None,
+        port: Optional[str] = None,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        step: Optional[int] = None,
+        authorize: AuthJWT = Depends()
+):
     """
-    /devices/data - POST - aggregator sends data which is saved in the Database
+    /devices/{id}/live - GET - live counter series of a device between start and end, merged into step seconds
     """
     authorize.jwt_required()
 
-    success = mongo.add_data_for_devices(devices=request.devices, external_events=request.external_events)
-    if (isinstance(success, bool) is True and success is False) or (isinstance(success, int) and success == -1):
+    if not ObjectId.is_valid(id) or (step is not None and step <= 0):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    series = await db.get_live_data(id, counter=counter, port=port, start=local_time(start), end=local_time(end),
+                                    step=step)
+    if isinstance(series, bool) and series is False:
         raise HTTPException(status_code=400, detail="Error occurred")
+
+    return LiveDataOut(device=id, step=step, series=series)
+
+
+@app.websocket("/api/devices/{id}/live/ws")
+async def live_data_websocket(
+        websocket: WebSocket,
+        id: str,
+        token: str = "",
+        port: Optional[str] = None,
+        counter: Optional[str] = None,
+        rate: Optional[float] = None,
+        authorize: AuthJWT = Depends()
+):
+    """
+    /devices/{id}/live/ws - WebSocket - buffered and then new live counter samples of a device
+    """
+    await websocket.accept()
+    try:
+        authorize.jwt_required("websocket", token=token)
+        if not ObjectId.is_valid(id) or (rate is not None and rate <= 0):
+            raise HTTPException(status_code=400, detail=BAD_PARAM)
+        hostname = await db.get_hostname_from_device_id(id)
+        if hostname is None:
+            raise HTTPException(status_code=404, detail="Device not found")
+    except (AuthJWTException, HTTPException):
+        await websocket.close(code=1008)
+        return
+
+    ports = port.split(",") if port else None
+    counters = counter.split(",") if counter else None
+    max_rate = config("live_max_rate", cast=float, default=2)
+    interval = 1 / min(rate or max_rate, max_rate)
+
+    def select(message: dict):
+        if message["device"] != hostname:
+            return []
+        return [sample for sample in message["samples"]
+                if (ports is None or sample["port"] in ports) and (counters is None or sample["counter"] in counters)]
+
+    subscription = broker.subscribe(LIVE_CHANNEL, lambda message: message["device"] == hostname,
+                                    config("stream_queue_size", cast=int, default=1000))
+
+    async def send():
+        loop = asyncio.get_running_loop()
+        try:
+            # Subscribed first, samples that are in the backfill and arrive again are dropped once
+            backfill = await db.get_live_ring(hostname, ports, counters)
+            seen = {(sample["port"], sample["counter"], sample["time"]) for sample in backfill}
+            await websocket.send_text(json.dumps({"type": "backfill", "samples": backfill}))
+
+            pending = []
+            next_send = loop.time()
+            while True:
+                if pending:
+                    delay = next_send - loop.time()
+                    if delay <= 0:
+                        await websocket.send_text(json.dumps({"type": "samples", "samples": pending}))
+                        pending = []
+                        seen = set()
+                        next_send = loop.time() + interval
+                        continue
+                    try:
+                        message = await asyncio.wait_for(subscription.get(), delay)
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    message = await subscription.get()
+
+                if message is None:
+                    # Fell behind, the client reconnects and gets a new backfill
+                    await websocket.close(code=1013)
+                    return
+                for sample in select(message):
+                    if (sample["port"], sample["counter"], sample["time"]) not in seen:
+                        pending.append(sample)
+        finally:
+            subscription.close()
+
+    await serve_websocket(websocket, send)
+
+
+def ingest_payload(payload: IngestPayload):
+    """
+    Writes a spooled report batch by batch, returns the number of devices or False if the ingest queue is full
+    """
+    batches = payload.batches(config("ingest_batch_devices", cast=int, default=100))
+    if ingest_queue is not None:
+        sizes = []
+
+        def queued():
+            for batch, external_events in batches:
+                sizes.append(len(batch))
+                yield {"devices": batch, "external_events": external_events}
+
+        # All batches or none, a client retrying after 429 must not get earlier batches ingested twice
+        if not ingest_queue.put_many(queued()):
+            return False
+        return sum(sizes)
+
+    devices = 0
+    for batch, external_events in batches:
+        success = mongo.add_data_for_devices_bulk(devices=batch, external_events=external_events)
+        if (isinstance(success, bool) is True and success is False) or (isinstance(success, int) and success == -1):
+            raise PayloadError(400, "Error occurred")
+        devices += len(batch)
+    return devices
+
+
+@app.post("/api/devices/data", response_model=AddDataForDeviceOut, tags=["Device"])
+async def devices_data(request: Request, authorize: AuthJWT = Depends()):
+    """
+    /devices/data - POST - aggregator sends JSON or MessagePack data which is saved in the Database
+    """
+    authorize.jwt_required()
+
+    try:
+        payload = IngestPayload(request.headers.get("Content-Type"), request.headers.get("Content-Encoding"),
+                                max_bytes=config("ingest_max_bytes", cast=int, default=256 * 1024 * 1024))
+    except PayloadError as error:
+        raise HTTPException(status_code=error.status_code, detail=error.detail)
+
+    try:
+        await payload.read(request, db.run)
+        devices = await db.run(ingest_payload, payload)
+    except PayloadError as error:
+        raise HTTPException(status_code=error.status_code, detail=error.detail)
+    finally:
+        payload.close()
+
+    if ingest_queue is not None:
+        # Write-behind: the payload is durable once queued, consumers write it to MongoDB
+        if devices is False:
+            raise HTTPException(status_code=429, detail="Ingest queue full", headers={"Retry-After": "5"})
+        return JSONResponse(status_code=202, content=AddDataForDeviceOut(detail="queued").dict())
     return AddDataForDeviceOut(detail="success")
 
 
@@ -480,6 +687,7 @@ async def get_alerts_by_device(
         severity: Optional[str] = None,
         page: Optional[int] = None,
         amount: Optional[int] = None,
+        after: Optional[str] = None,
         authorize: AuthJWT = Depends()
 ):
     """
@@ -487,6 +695,9 @@ async def get_alerts_by_device(
     """
     authorize.jwt_required()
 
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
     events = []
     new_sevs = []
     if severity:
@@ -499,31 +710,37 @@ async def get_alerts_by_device(
                     new_sevs.append(int(sev))
 
 
-        current_events = mongo.get_events(page=page,
-                                          amount=amount,
-                                          min_severity=min_severity,
-                                          severities=new_sevs,
-                                          device_id=id)
+        current_events = await db.get_events(page=page,
+                                             amount=amount,
+                                             min_severity=min_severity,
+                                             severities=new_sevs,
+                                             device_id=id,
+                                             after=after)
         if isinstance(current_events, bool) is False and current_events is not False:
             events = current_events
     else:
         severity = None
 
 
-        current_events = mongo.get_events(page=page,
-                                          amount=amount,
-                                          min_severity=min_severity,
-                                          severities=severity,
-                                          device_id=id)
+        current_events = await db.get_events(page=page,
+                                             amount=amount,
+                                             min_severity=min_severity,
+                                             severities=severity,
+                                             device_id=id,
+                                             after=after)
         if isinstance(current_events, bool) is False and current_events is not False:
             events = current_events
 
-    total = mongo.get_event_count(device_id=id, severities=new_sevs, min_severity=min_severity)
+    total = await db.get_event_count(device_id=id, severities=new_sevs, min_severity=min_severity)
     #total = len(events)
 
     if isinstance(events, bool) and events is False:
         raise HTTPException(status_code=400, detail="Error occurred")
-    return GetAllAlertsOut(page=page, amount=amount, total=total, alerts=events)
+
+    next_cursor = None
+    if (after is not None or page) and amount and len(events) == amount:
+        next_cursor = events[-1]["id"]
+    return GetAllAlertsOut(page=page, amount=amount, total=total, alerts=events, next_cursor=next_cursor)
 
 
 @app.post("/api/devices", response_model=AddDeviceOut, tags=["Device"])
@@ -533,7 +750,7 @@ async def add_device(request: AddDeviceIn, authorize: AuthJWT = Depends()):
     """
     authorize.jwt_required()
 
-    if mongo.add_device_web(request.hostname, request.category, request.ip):
+    if await db.add_device_web(request.hostname, request.category, request.ip):
         return AddDeviceOut(detail="success")
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
@@ -546,7 +763,7 @@ async def delete_device(id: str, authorize: AuthJWT = Depends()):
     authorize.jwt_required()
 
     id = ObjectId(id)
-    if mongo.delete_device_web(id):
+    if await db.delete_device_web(id):
         return AddDeviceOut(detail="success")
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
@@ -560,14 +777,13 @@ async def get_device_config(id: str = None, authorize: AuthJWT = Depends()):
 
     if id:
         id = ObjectId(str(id))
-        query_result = mongo.get_device_config(id)
+        query_result = await db.get_device_config(id)
         configs = []
         if query_result is not False and query_result != -1:
             for c in query_result:
                 name = c.type.type
                 type = c.type.to_son().to_dict()
-                type.pop("_id")
-                conf = crypt.decrypt(type["config"], config("cryptokey"))
+                conf = await db.run(mongo.decrypt_config, type.pop("_id"), type["config"])
                 type["config"] = conf.replace('"', "'")
                 if c.config is None:
                     c.config = []
@@ -593,7 +809,7 @@ async def add_device_config(id: str, request: SetConfig, authorize: AuthJWT = De
     authorize.jwt_required()
 
     id = ObjectId(id)
-    query_result = mongo.set_device_config(id, request.config)
+    query_result = await db.set_device_config(id, request.config)
 
     if not query_result or query_result == -1:
         raise HTTPException(status_code=400, detail="Failed")
@@ -623,7 +839,7 @@ async def get_all_categories(authorize: AuthJWT = Depends()):
     """
     authorize.jwt_required()
 
-    result = mongo.get_categories()
+    result = await db.get_categories()
 
     return GetCategoriesOut(categories=result)
 
@@ -635,7 +851,7 @@ async def add_categories(request: AddCategoryIn, authorize: AuthJWT = Depends())
     """
     authorize.jwt_required()
 
-    if mongo.add_category(category=request.category):
+    if await db.add_category(category=request.category):
         return AddCategoryOut(detail="success")
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
@@ -647,7 +863,7 @@ async def delete_categories(id: str, authorize: AuthJWT = Depends()):
     """
     authorize.jwt_required()
 
-    if mongo.delete_category(category_id=id):
+    if await db.delete_category(category_id=id):
         return AddCategoryOut(detail="success")
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
@@ -659,6 +875,7 @@ async def get_all_alerts(
         severity: Optional[str] = None,
         page: Optional[int] = None,
         amount: Optional[int] = None,
+        after: Optional[str] = None,
         authorize: AuthJWT = Depends()
 ):
     """
@@ -666,6 +883,9 @@ async def get_all_alerts(
     """
     authorize.jwt_required()
 
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
     events = []
     new_sevs = []
     if severity:
@@ -677,28 +897,188 @@ async def get_all_alerts(
                 if mongo.__is_int__(sev):
                     new_sevs.append(int(sev))
 
-        current_events = mongo.get_events(page=page,
-                                          amount=amount,
-                                          min_severity=min_severity,
-                                          severities=new_sevs)
+        current_events = await db.get_events(page=page,
+                                             amount=amount,
+                                             min_severity=min_severity,
+                                             severities=new_sevs,
+                                             after=after)
         if isinstance(current_events, bool) is False and current_events is not False:
             events = current_events
     else:
         severity = None
 
-        current_events = mongo.get_events(page=page,
-                                          amount=amount,
-                                          min_severity=min_severity,
-                                          severities=severity)
+        current_events = await db.get_events(page=page,
+                                             amount=amount,
+                                             min_severity=min_severity,
+                                             severities=severity,
+                                             after=after)
         if isinstance(current_events, bool) is False and current_events is not False:
             events = current_events
 
-    total = mongo.get_event_count(severities=new_sevs, min_severity=min_severity)
+    total = await db.get_event_count(severities=new_sevs, min_severity=min_severity)
     #total = len(events)
 
     if isinstance(events, bool) and events is False:
         raise HTTPException(status_code=400, detail="Error occurred")
-    return GetAllAlertsOut(page=page, amount=amount, total=total, alerts=events)
+
+    next_cursor = None
+    if (after is not None or page) and amount and len(events) == amount:
+        next_cursor = events[-1]["id"]
+    return GetAllAlertsOut(page=page, amount=amount, total=total, alerts=events, next_cursor=next_cursor)
+
+
+async def serve_websocket(websocket: WebSocket, send):
+    """
+    Runs send until it returns or the client goes away, whichever happens first
+    """
+    async def receive():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(send()), asyncio.ensure_future(receive())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def alert_filter(device_id: Optional[str], min_severity: Optional[int]):
+    def match(event: dict):
+        if device_id is not None and event["device_id"] != device_id:
+            return False
+        return min_severity is None or event["severity"] >= min_severity
+    return match
+
+
+async def alert_backlog(after: int, device_id: Optional[str], min_severity: Optional[int]):
+    """
+    Yields the events stored after the resume sequence, page by page
+    """
+    while True:
+        events = await db.get_events_since(after, min_severity=min_severity, device_id=device_id)
+        for event in events:
+            yield event
+        if len(events) < 1000:
+            return
+        after = events[-1]["sequence"]
+
+
+async def alert_stream(subscription, after: Optional[int], device_id: Optional[str], min_severity: Optional[int]):
+    """
+    Yields the events a client missed since the sequence after, then new ones from the broker
+    """
+    heartbeat = config("stream_heartbeat", cast=int, default=15)
+    # The backlog and the broker can both deliver an event, and worker processes publish out of sequence order
+    recent = deque(maxlen=2 * config("stream_queue_size", cast=int, default=1000))
+    sent = set()
+
+    def first_time(event: dict):
+        if event["sequence"] in sent:
+            return False
+        if len(recent) == recent.maxlen:
+            sent.discard(recent[0])
+        recent.append(event["sequence"])
+        sent.add(event["sequence"])
+        return True
+
+    try:
+        if after is not None:
+            async for event in alert_backlog(after, device_id, min_severity):
+                if first_time(event):
+                    yield event
+
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is None:
+                # Closed because the client fell behind, it reconnects and resumes from its last sequence
+                return
+            if first_time(event):
+                yield event
+    finally:
+        subscription.close()
+
+
+def check_alert_stream_params(device_id: Optional[str], min_severity: Optional[int], after: Optional[str]):
+    """
+    Returns the resume sequence as int
+    """
+    if device_id is not None and not ObjectId.is_valid(device_id):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+    if min_severity is not None and (min_severity < 0 or min_severity > 10):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+    if after is None:
+        return None
+    if not after.isdigit():
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+    return int(after)
+
+
+@app.get("/api/alerts/stream", tags=["Alert"])
+async def stream_alerts(
+        request: Request,
+        device_id: Optional[str] = None,
+        min_severity: Optional[int] = None,
+        after: Optional[str] = None,
+        authorize: AuthJWT = Depends()
+):
+    """
+    /alerts/stream - GET - server-sent events of new alerts, resumed after Last-Event-ID
+    """
+    authorize.jwt_required()
+
+    after = check_alert_stream_params(device_id, min_severity, request.headers.get("last-event-id") or after)
+
+    subscription = broker.subscribe(EVENTS_CHANNEL, alert_filter(device_id, min_severity),
+                                     config("stream_queue_size", cast=int, default=1000))
+
+    async def events():
+        async for event in alert_stream(subscription, after, device_id, min_severity):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {event['sequence']}\nevent: alert\ndata: {json.dumps(event, default=str)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/api/alerts/ws")
+async def stream_alerts_websocket(
+        websocket: WebSocket,
+        token: str = "",
+        device_id: Optional[str] = None,
+        min_severity: Optional[int] = None,
+        after: Optional[str] = None,
+        authorize: AuthJWT = Depends()
+):
+    """
+    /alerts/ws - WebSocket - the alert stream as JSON messages, the access token is passed as token
+    """
+    await websocket.accept()
+    try:
+        authorize.jwt_required("websocket", token=token)
+        after = check_alert_stream_params(device_id, min_severity, after)
+    except (AuthJWTException, HTTPException):
+        await websocket.close(code=1008)
+        return
+
+    subscription = broker.subscribe(EVENTS_CHANNEL, alert_filter(device_id, min_severity),
+                                    config("stream_queue_size", cast=int, default=1000))
+
+    async def send():
+        async for event in alert_stream(subscription, after, device_id, min_severity):
+            if event is not None:
+                await websocket.send_text(json.dumps(event, default=str))
+        # Fell behind, the client reconnects with the sequence of its last alert
+        await websocket.close(code=1013)
+
+    await serve_websocket(websocket, send)
 
 
 @app.get("/api/alerts/{event_id}", response_model=GetAlertByIdOut, tags=["Alert"])
@@ -708,20 +1088,128 @@ async def get_alert_by_id(event_id: str, authorize: AuthJWT = Depends()):
     """
     authorize.jwt_required()
 
-    event = mongo.get_event_by_id(event_id)
+    event = await db.get_event_by_id(event_id)
 
     if isinstance(event, dict) is True:
         return GetAlertByIdOut(event=event)
     raise HTTPException(status_code=400, detail=BAD_PARAM)
 
 
+export_types = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+export_device_columns = ["id", "hostname", "ip", "category"]
+export_alert_columns = ["id", "timestamp", "severity", "event", "device_id", "device"]
+
+
+def encode_export_batch(rows: list, format: str, columns: list, header: bool):
+    if format == "ndjson":
+        return "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+def export_response(batches, format: str, columns: list, filename: str):
+    """
+    Streams the batches of an export generator, each fetched on the database executor
+    """
+    async def body():
+        done = object()
+        header = True
+        try:
+            while True:
+                rows = await db.run(next, batches, done)
+                if rows is done:
+                    if header and format == "csv":
+                        yield encode_export_batch([], format, columns, True)
+                    return
+                yield encode_export_batch(rows, format, columns, header)
+                header = False
+        finally:
+            # Releases the cursor when the client goes away mid-export
+            try:
+                await db.run(batches.close)
+            except ValueError:
+                # Still reading the batch the cancelled request waited for, the cursor is closed when it is dropped
+                pass
+
+    return StreamingResponse(body(), media_type=export_types[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}.{format}"'})
+
+
+@app.get("/api/export/devices", tags=["Export"])
+async def export_devices(
+        category: Optional[str] = None,
+        format: str = "ndjson",
+        authorize: AuthJWT = Depends()
+):
+    """
+    /export/devices - GET - all devices as NDJSON (with static, live and module data) or CSV
+    """
+    authorize.jwt_required()
+
+    if format not in export_types:
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    categories = []
+    if category:
+        for temp in category.split("_"):
+            if not ObjectId.is_valid(temp):
+                raise HTTPException(status_code=400, detail=BAD_PARAM)
+            categories.append(ObjectId(temp))
+
+    batches = mongo.export_devices(categories=categories, full=format == "ndjson",
+                                   batch_size=config("export_batch_size", cast=int, default=500))
+    return export_response(batches, format, export_device_columns, "devices")
+
+
+@app.get("/api/export/alerts", tags=["Export"])
+async def export_alerts(
+        min_severity: Optional[int] = None,
+        severity: Optional[str] = None,
+        device_id: Optional[str] = None,
+        format: str = "ndjson",
+        authorize: AuthJWT = Depends()
+):
+    """
+    /export/alerts - GET - all alerts as NDJSON or CSV, newest first
+    """
+    authorize.jwt_required()
+
+    if format not in export_types:
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+    if device_id is not None and not ObjectId.is_valid(device_id):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+    if min_severity is not None and (min_severity < 0 or min_severity > 10):
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    severities = None
+    if severity:
+        severities = [int(sev) for sev in severity.split('_') if mongo.__is_int__(sev)]
+
+    batches = mongo.export_events(severities=severities, min_severity=min_severity, device_id=device_id,
+                                  batch_size=config("export_batch_size", cast=int, default=500))
+    return export_response(batches, format, export_alert_columns, "alerts")
+
+
 @app.get("/api/tree", response_model=TreeJson, tags=["Tree View"])
-async def get_tree(authorize: AuthJWT = Depends(), vlan_id: Optional[int] = None):
+async def get_tree(request: Request, authorize: AuthJWT = Depends(), vlan_id: Optional[int] = None):
     """
     /tree/ - GET - get tree view
     """
     authorize.jwt_required()
-    return mongo.get_tree(vlan_id)
+
+    # Connections are built by the process holding the background-jobs lease, the version is shared
+    topology_version = await db.get_topology_version()
+    etag = mongo.get_tree_etag(topology_version, vlan_id)
+    if etag is not None and request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    view = await db.get_tree_view(vlan_id, topology_version)
+    return Response(content=view["json"], media_type="application/json", headers={"ETag": view["etag"]})
 
 
 @app.get("/api/devices/filter", response_model=DevicesFilterOut, tags=["Device"])
@@ -730,14 +1218,18 @@ async def filter_devices(key: str,
                          page: Optional[int] = None,
                          amount: Optional[int] = None,
                          category_id: Optional[str] = None,
+                         match: str = "substring",
                          authorize: AuthJWT = Depends()
                          ):
     """
-    /devices/filter - GET - get filtered devices
+    /devices/filter - GET - get filtered devices, match is exact, prefix or substring
     """
     authorize.jwt_required()
 
-    return mongo.filter_devices(key, value, page, amount, category_id)
+    if match not in ["exact", "prefix", "substring"]:
+        raise HTTPException(status_code=400, detail=BAD_PARAM)
+
+    return await db.filter_devices(key, value, page, amount, category_id, match)
 
 
 @app.get("/api/filter", response_model=FilterOut, tags=["Device"])
@@ -756,7 +1248,7 @@ async def get_all_modules(authorize: AuthJWT = Depends()):
     """
     authorize.jwt_required()
 
-    query = mongo.get_types()
+    query = await db.get_types()
 
     return JSONResponse(status_code=200, content=query)
 
@@ -768,7 +1260,7 @@ async def delete_module_from_device(module_id: str, device_id: str, authorize: A
        """
     authorize.jwt_required()
 
-    query_result = mongo.delete_module(module_id=module_id, device_id=device_id)
+    query_result = await db.delete_module(module_id=module_id, device_id=device_id)
 
     if not query_result or query_result == -1:
         raise HTTPException(status_code=400, detail="Not found")
@@ -796,7 +1288,7 @@ async def get_devices_by_category(
     if hasattr(request, "category"):
         category = request.category
 
-    if mongo.update_device(id=id, hostname=hostname, ip=ip, category=category):
+    if await db.update_device(id=id, hostname=hostname, ip=ip, category=category):
         return JSONResponse(status_code=200, content="Success")
     raise HTTPException(status_code=400, detail="Failed")
 
@@ -813,7 +1305,7 @@ async def get_devices_by_category(
 
     authorize.jwt_required()
 
-    if mongo.update_category(id=id, category=request.category):
+    if await db.update_category(id=id, category=request.category):
         return JSONResponse(status_code=200, content="Success")
     raise HTTPException(status_code=400, detail="Failed")
 
@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from decouple import config as dconfig
+
+from src.mongoDBIO import MongoDBIO
+
+
+class AsyncMongoDBIO:
+    """
+    Awaitable facade of MongoDBIO, every public method runs on a bounded thread pool
+    """
+
+    def __init__(self, mongo: MongoDBIO, max_workers: int = None):
+        self.mongo = mongo
+        if max_workers is None:
+            max_workers = dconfig("db_workers", cast=int, default=16)
+        self.max_workers = max_workers
+        self.executor = None
+        self.latencies = deque(maxlen=1000)
+        self.metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "max_wait": 0.0,
+        }
+
+        # Threads do not survive a fork, the child creates its own pool on first use
+        os.register_at_fork(after_in_child=self.__after_fork__)
+
+    def __after_fork__(self):
+        self.executor = None
+
+    def __getattr__(self, name):
+        attribute = getattr(self.mongo, name)
+        if name.startswith("__") or not callable(attribute) or asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attribute, *args, **kwargs)
+
+        return wrapper
+
+    async def run(self, function, *args, **kwargs):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mongo")
+
+        timings = {"submitted": time.perf_counter()}
+
+        def call():
+            timings["started"] = time.perf_counter()
+            return function(*args, **kwargs)
+
+        self.metrics["submitted"] += 1
+        self.metrics["in_flight"] += 1
+        self.metrics["max_in_flight"] = max(self.metrics["max_in_flight"], self.metrics["in_flight"])
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+            self.metrics["completed"] += 1
+            return result
+        except Exception:
+            self.metrics["failed"] += 1
+            raise
+        finally:
+            finished = time.perf_counter()
+            self.metrics["in_flight"] -= 1
+            if "started" in timings:
+                self.metrics["max_wait"] = max(self.metrics["max_wait"], timings["started"] - timings["submitted"])
+            self.latencies.append(finished - timings["submitted"])
+
+    def get_executor_metrics(self):
+        metrics = dict(self.metrics)
+        metrics["max_workers"] = self.max_workers
+
+        latencies = sorted(self.latencies)
+        if latencies:
+            metrics["p50"] = latencies[int(len(latencies) * 0.50)]
+            metrics["p99"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return metrics
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import threading
+
+import redis
+
+# Redis pub/sub channels MongoDBIO publishes on
+EVENTS_CHANNEL = "netapi:events"
+LIVE_CHANNEL = "netapi:live"
+
+
+class Subscription:
+    """
+    Bounded queue of the matching messages of one channel, closed once it falls max_size behind
+    """
+
+    def __init__(self, broker, channel: str, match=None, max_size: int = 1000):
+        self.broker = broker
+        self.channel = channel
+        self.match = match
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.closed = False
+
+    def offer(self, message):
+        if self.closed or (self.match is not None and not self.match(message)):
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.broker.metrics["overflows"] += 1
+            self.close()
+            return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.broker.unsubscribe(self)
+        # Wakes up a waiting get, a full queue is drained before the None is seen
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Broker:
+    """
+    Fans messages published on Redis channels out to the subscribers of this process
+    """
+
+    def __init__(self, channels: list):
+        self.channels = channels
+        self.subscriptions = {channel: set() for channel in channels}
+        self.loop = None
+        self.client = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.metrics = {"received": 0, "delivered": 0, "overflows": 0, "reconnects": 0}
+
+    def subscribe(self, channel: str, match=None, max_size: int = 1000):
+        """
+        Must be called from the event loop, match(message) decides which messages the subscriber gets
+        """
+        subscription = Subscription(self, channel, match, max_size)
+        self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions[subscription.channel].discard(subscription)
+
+    def dispatch(self, channel: str, message):
+        self.metrics["received"] += 1
+        for subscription in list(self.subscriptions[channel]):
+            if subscription.offer(message):
+                self.metrics["delivered"] += 1
+
+    def start(self, loop, client: redis.Redis):
+        self.loop = loop
+        self.client = client
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__listen__, name="broker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def __listen__(self):
+        while not self.stopped.is_set():
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(*self.channels)
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None or message["type"] != "message":
+                        continue
+                    channel = str(message["channel"], "utf-8")
+                    self.loop.call_soon_threadsafe(self.dispatch, channel, json.loads(message["data"]))
+            except redis.RedisError as error:
+                print(f"Broker lost Redis: {error}")
+                self.metrics["reconnects"] += 1
+                # Messages published meanwhile are lost, subscribers reconnect and resume from their last sequence
+                self.loop.call_soon_threadsafe(self.__close_all__)
+                self.stopped.wait(1)
+            finally:
+                pubsub.close()
+
+    def __close_all__(self):
+        for subscriptions in self.subscriptions.values():
+            for subscription in list(subscriptions):
+                subscription.close()
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        metrics["subscribers"] = sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+        return metrics
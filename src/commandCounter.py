@@ -0,0 +1,24 @@
+import threading
+
+from pymongo import monitoring
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the MongoDB commands each thread sent, getMore included
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def started(self, event):
+        self.local.count = self.count() + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def count(self):
+        return getattr(self.local, "count", 0)
@@ -0,0 +1,116 @@
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from src.models.aggregator import Aggregator
+from src.models.counter import Counter
+from src.models.device import Device, Category, Data, SearchEntry
+from src.models.event import Event, EventCount
+from src.models.lease import Lease
+from src.models.live import LiveBucket
+from src.models.node import Link, Node, Connection
+
+
+class IndexAdvisor:
+    """
+    Runs explain() on every query shape MongoDBIO issues and reports the ones that end up in a COLLSCAN
+    """
+
+    def __init__(self):
+        device_id = ObjectId()
+        self.query_shapes = [
+            ("events", Event, {}, [('_id', DESCENDING)]),
+            ("events by device", Event, {"device": device_id}, [('_id', DESCENDING)]),
+            ("events by min severity", Event, {"severity": {"$gte": 3}}, [('_id', DESCENDING)]),
+            ("events by severities", Event, {"severity": {"$in": [3, 5]}}, [('_id', DESCENDING)]),
+            ("events by device and min severity", Event,
+             {"device": device_id, "severity": {"$gte": 3}}, [('_id', DESCENDING)]),
+            ("events by device and severities", Event,
+             {"device": device_id, "severity": {"$in": [3, 5]}}, [('_id', DESCENDING)]),
+            ("event deduplication", Event,
+             {"event": "event", "device": device_id, "timestamp": "2022-01-01 00:00:00"}, None),
+            ("events past expiry", Event, {"expires_at": {"$lte": datetime(2022, 1, 1)}}, [('_id', ASCENDING)]),
+            ("events without expiry", Event, {"expires_at": {"$exists": False}, "severity": {"$in": [3, 5]}}, None),
+            ("events since sequence", Event, {"sequence": {"$gt": 0}}, [('sequence', ASCENDING)]),
+            ("events by device and min severity since sequence", Event,
+             {"device": device_id, "severity": {"$gte": 3}, "sequence": {"$gt": 0}}, [('sequence', ASCENDING)]),
+            ("event counts by device", EventCount, {"device": device_id}, None),
+            ("global event counts", EventCount, {"device": None}, None),
+            ("device by hostname", Device, {"hostname": "hostname"}, None),
+            ("devices by hostnames", Device, {"hostname": {"$in": ["hostname"]}}, None),
+            ("devices by ids", Device, {"_id": {"$in": [device_id]}}, None),
+            ("data by ids", Data, {"_id": {"$in": [ObjectId()]}}, None),
+            ("category by name", Category, {"category": "Switch"}, None),
+            ("search exact", SearchEntry, {"key": "name", "value": "value"}, None),
+            ("search prefix", SearchEntry, {"key": "name", "value": {"$regex": "^value"}}, None),
+            ("search substring", SearchEntry, {"key": "name", "value": {"$regex": "value"}}, None),
+            ("search entries by data", SearchEntry, {"data": {"$in": [ObjectId()]}}, None),
+            ("live buckets by device", LiveBucket,
+             {"device": device_id, "resolution": {"$in": ["raw"]}, "start": {"$gt": datetime(2022, 1, 1)}}, None),
+            ("live buckets by counter", LiveBucket,
+             {"device": device_id, "resolution": {"$in": ["raw"]}, "counter": "in_bytes",
+              "start": {"$gt": datetime(2022, 1, 1)}}, None),
+            ("live buckets by port", LiveBucket,
+             {"device": device_id, "resolution": {"$in": ["raw"]}, "counter": "in_bytes", "port": "port",
+              "start": {"$gt": datetime(2022, 1, 1)}}, None),
+            ("live buckets past retention", LiveBucket,
+             {"resolution": "raw", "start": {"$lte": datetime(2022, 1, 1)}}, None),
+            ("aggregator by token", Aggregator, {"token": "token"}, None),
+            ("aggregator by identifier", Aggregator, {"identifier": "identifier"}, None),
+            ("aggregator by device", Aggregator, {"devices": device_id}, None),
+            ("node by hostname", Node, {"hostname": "hostname"}, None),
+            ("links by node", Link, {"node": ObjectId()}, None),
+            ("link by mac pair", Link, {"mac": "00:00:00:00:00:00", "remote_mac": "00:00:00:00:00:01"}, None),
+            ("connection by link pair", Connection,
+             {"$or": [{"source": ObjectId(), "target": ObjectId()}, {"source": ObjectId(), "target": ObjectId()}]},
+             None),
+            ("counter by name", Counter, {"_id": "event_sequence"}, None),
+            ("lease by name", Lease,
+             {"_id": "lease", "$or": [{"owner": "owner"}, {"expires": {"$lt": datetime(2022, 1, 1)}}]}, None),
+        ]
+
+    def add_query_shape(self, name: str, model, query: dict, sort: list = None):
+        self.query_shapes.append((name, model, query, sort))
+
+    def explain(self, model, query: dict, sort: list = None):
+        # Use the query pymodm actually sends, including the _cls type filter
+        raw_query = model.objects.raw(query).raw_query
+        cursor = model._mongometa.collection.find(raw_query)
+        if sort:
+            cursor = cursor.sort(sort)
+        return cursor.explain()["queryPlanner"]["winningPlan"]
+
+    def __stages__(self, plan: dict):
+        stages = [plan["stage"]]
+        if "inputStage" in plan:
+            stages.extend(self.__stages__(plan["inputStage"]))
+        for input_stage in plan.get("inputStages", []):
+            stages.extend(self.__stages__(input_stage))
+        return stages
+
+    def run(self):
+        report = []
+        for name, model, query, sort in self.query_shapes:
+            stages = self.__stages__(self.explain(model, query, sort))
+            report.append({
+                "name": name,
+                "collection": model._mongometa.collection_name,
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages
+            })
+        return report
+
+    def print_report(self, report: list = None):
+        if report is None:
+            report = self.run()
+
+        collscans = 0
+        for entry in report:
+            if entry["collscan"]:
+                collscans += 1
+                print(f"COLLSCAN  {entry['collection']}: {entry['name']} ({' <- '.join(entry['stages'])})")
+            else:
+                print(f"OK        {entry['collection']}: {entry['name']} ({' <- '.join(entry['stages'])})")
+        print(f"{collscans} of {len(report)} query shapes need a collection scan")
+        return collscans
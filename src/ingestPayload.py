@@ -0,0 +1,165 @@
+import tempfile
+import zlib
+
+import ijson
+import msgpack
+import orjson
+import zstandard
+
+
+class PayloadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class IngestPayload:
+    """
+    An aggregator report spooled from the request body, parsed one device at a time
+    """
+
+    json_types = ["", "application/json"]
+    msgpack_types = ["application/msgpack", "application/x-msgpack"]
+
+    def __init__(self, content_type: str = None, content_encoding: str = None, max_bytes: int = 256 * 1024 * 1024,
+                 spool_bytes: int = 1024 * 1024):
+        content_type = (content_type or "").split(";")[0].strip().lower()
+        content_encoding = (content_encoding or "identity").strip().lower()
+
+        if content_type in self.json_types:
+            self.format = "json"
+        elif content_type in self.msgpack_types:
+            self.format = "msgpack"
+        else:
+            raise PayloadError(415, f"Unsupported content type {content_type}")
+
+        if content_encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif content_encoding == "zstd":
+            # Writes the decompressed output to self.write in small pieces
+            self.decompressor = zstandard.ZstdDecompressor().stream_writer(self, closefd=False)
+        elif content_encoding == "identity":
+            self.decompressor = None
+        else:
+            raise PayloadError(415, f"Unsupported content encoding {content_encoding}")
+        self.content_encoding = content_encoding
+
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self.size = 0
+        self.wire_size = 0
+        self.small = None
+
+    def feed(self, chunk: bytes):
+        """
+        Adds a chunk of the body as it came over the wire
+        """
+        self.wire_size += len(chunk)
+        try:
+            if self.content_encoding == "gzip":
+                # Bounded, so a compression bomb fails before it is inflated
+                self.write(self.decompressor.decompress(chunk, self.max_bytes - self.size + 1))
+                if self.decompressor.unconsumed_tail:
+                    raise PayloadError(413, "Payload too large")
+            elif self.content_encoding == "zstd":
+                self.decompressor.write(chunk)
+            else:
+                self.write(chunk)
+        except (zlib.error, zstandard.ZstdError) as error:
+            raise PayloadError(400, f"Malformed {self.content_encoding} body: {error}")
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise PayloadError(413, "Payload too large")
+        self.file.write(data)
+        return len(data)
+
+    async def read(self, request, run):
+        """
+        Spools the body of a starlette request, run(function, *args) calls feed off the event loop
+        """
+        async for chunk in request.stream():
+            if chunk:
+                await run(self.feed, chunk)
+        await run(self.finish)
+
+    def finish(self):
+        if self.content_encoding == "gzip" and not self.decompressor.eof:
+            raise PayloadError(400, "Truncated gzip body")
+        self.file.seek(0)
+
+    def external_events(self):
+        self.file.seek(0)
+        try:
+            if self.size <= self.spool_bytes:
+                return self.__load_small__().get("external_events", {})
+            if self.format == "json":
+                for events in ijson.items(self.file, "external_events", use_float=True):
+                    return events
+                return {}
+            return self.__msgpack_value__("external_events", lambda unpacker: unpacker.unpack()) or {}
+        except (ValueError, ijson.JSONError, msgpack.UnpackException) as error:
+            raise PayloadError(400, f"Malformed payload: {error}")
+
+    def devices(self):
+        self.file.seek(0)
+        try:
+            if self.size <= self.spool_bytes:
+                yield from self.__load_small__().get("devices", [])
+            elif self.format == "json":
+                yield from ijson.items(self.file, "devices.item", use_float=True)
+            else:
+                yield from self.__msgpack_value__("devices", self.__msgpack_items__) or []
+        except (ValueError, ijson.JSONError, msgpack.UnpackException) as error:
+            raise PayloadError(400, f"Malformed payload: {error}")
+
+    def batches(self, batch_size: int = 100):
+        """
+        Yields (devices, external_events) with at most batch_size devices, external events travel with the first batch
+        """
+        external_events = self.external_events()
+        if not isinstance(external_events, dict):
+            raise PayloadError(400, "external_events must be an object")
+
+        batch = []
+        for device in self.devices():
+            if not isinstance(device, dict) or "name" not in device:
+                raise PayloadError(400, "Every device needs a name")
+            batch.append(device)
+            if len(batch) == batch_size:
+                yield batch, external_events
+                external_events = {}
+                batch = []
+
+        if batch or external_events:
+            yield batch, external_events
+
+    def __load_small__(self):
+        # Small reports are parsed in one go, orjson and msgpack beat the streaming parsers there
+        if self.small is None:
+            data = self.file.read()
+            if self.format == "json":
+                self.small = orjson.loads(data)
+            else:
+                self.small = msgpack.unpackb(data, raw=False, strict_map_key=False)
+            if not isinstance(self.small, dict):
+                raise PayloadError(400, "Payload must be an object")
+        return self.small
+
+    def __msgpack_value__(self, key: str, read):
+        unpacker = msgpack.Unpacker(self.file, raw=False, strict_map_key=False, max_buffer_size=self.max_bytes)
+        for _ in range(0, unpacker.read_map_header()):
+            if unpacker.unpack() == key:
+                return read(unpacker)
+            unpacker.skip()
+        return None
+
+    def __msgpack_items__(self, unpacker):
+        for _ in range(0, unpacker.read_array_header()):
+            yield unpacker.unpack()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import msgpack
+
+
+class IngestQueue:
+    """
+    Bounded durable queue of /api/devices/data payloads in a SQLite WAL database
+    """
+
+    def __init__(self, path: str, max_size: int = 10000, claim_timeout: float = 300, max_attempts: int = 5):
+        self.path = path
+        self.max_size = max_size
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.connection = None
+        self.metrics = {
+            "enqueued": 0,
+            "rejected": 0,
+            "drained": 0,
+            "failed": 0,
+            "dead_lettered": 0,
+            "drain_lag": 0.0,
+            "max_drain_lag": 0.0,
+        }
+
+        os.register_at_fork(after_in_child=self.__after_fork__)
+
+    def __after_fork__(self):
+        # SQLite connections must not be used across a fork
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def __connect__(self):
+        if self.connection is None:
+            # Several worker processes can share the file, writers wait up to 30 seconds for the lock
+            self.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queue ("
+                                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "payload BLOB NOT NULL, "
+                                    "enqueued REAL NOT NULL, "
+                                    "claimed REAL, "
+                                    "attempts INTEGER NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(queue)")]
+            if "attempts" not in columns:
+                # Queue files written before attempts were counted
+                self.connection.execute("ALTER TABLE queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS dead_letter ("
+                                    "id INTEGER PRIMARY KEY, "
+                                    "payload BLOB NOT NULL, "
+                                    "enqueued REAL NOT NULL, "
+                                    "failed REAL NOT NULL, "
+                                    "attempts INTEGER NOT NULL, "
+                                    "error TEXT)")
+        return self.connection
+
+    def put(self, payload: dict):
+        """
+        Appends a payload, returns False if the queue already holds max_size entries
+        """
+        return self.put_many([payload])
+
+    def put_many(self, payloads):
+        """
+        Appends all payloads of an iterable in one transaction, or none of them if they do not fit into max_size
+        """
+        with self.lock:
+            connection = self.__connect__()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                depth = connection.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+                added = 0
+                for payload in payloads:
+                    if depth + added >= self.max_size:
+                        connection.execute("ROLLBACK")
+                        self.metrics["rejected"] += 1
+                        return False
+                    connection.execute("INSERT INTO queue (payload, enqueued) VALUES (?, ?)",
+                                       (self.__encode__(payload), time.time()))
+                    added += 1
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            self.metrics["enqueued"] += added
+            return True
+
+    def __encode__(self, payload: dict):
+        # MessagePack keeps the bytes values of msgpack reports, anything else it cannot encode is stored as text
+        return msgpack.packb(payload, use_bin_type=True, default=str)
+
+    def __decode__(self, payload):
+        if isinstance(payload, str):
+            # Queue files written before payloads were MessagePack
+            return json.loads(payload)
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+    def claim(self, batch_size: int = 10):
+        """
+        Hands out up to batch_size unclaimed (or abandoned) entries as [(id, enqueued, payload)], oldest first
+        """
+        with self.lock:
+            connection = self.__connect__()
+            now = time.time()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute("SELECT id, enqueued, payload FROM queue "
+                                          "WHERE claimed IS NULL OR claimed < ? ORDER BY id LIMIT ?",
+                                          (now - self.claim_timeout, batch_size)).fetchall()
+                connection.executemany("UPDATE queue SET claimed = ? WHERE id = ?", [(now, row[0]) for row in rows])
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return [(row[0], row[1], self.__decode__(row[2])) for row in rows]
+
+    def ack(self, ids: list):
+        with self.lock:
+            connection = self.__connect__()
+            connection.executemany("DELETE FROM queue WHERE id = ?", [(id,) for id in ids])
+
+    def release(self, ids: list, failed: int = None, error: str = None):
+        """
+        Hands the entries back, returns True if failed reached max_attempts and was dead-lettered
+        """
+        with self.lock:
+            connection = self.__connect__()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("UPDATE queue SET claimed = NULL WHERE id = ?",
+                                       [(id,) for id in ids if id != failed])
+                dead = False
+                if failed is not None:
+                    connection.execute("UPDATE queue SET claimed = NULL, attempts = attempts + 1 WHERE id = ?",
+                                       (failed,))
+                    dead = connection.execute("INSERT INTO dead_letter (id, payload, enqueued, failed, attempts, error) "
+                                              "SELECT id, payload, enqueued, ?, attempts, ? FROM queue "
+                                              "WHERE id = ? AND attempts >= ?",
+                                              (time.time(), error, failed, self.max_attempts)).rowcount > 0
+                    if dead:
+                        connection.execute("DELETE FROM queue WHERE id = ?", (failed,))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            if dead:
+                self.metrics["dead_lettered"] += 1
+            return dead
+
+    async def consume(self, db, batch_size: int = 10, idle: float = 0.5):
+        """
+        Drains the queue into MongoDB with add_data_for_devices_bulk until cancelled, db is an AsyncMongoDBIO
+        """
+        while True:
+            entries = await db.run(self.claim, batch_size)
+            if not entries:
+                await asyncio.sleep(idle)
+                continue
+
+            done = []
+            current = None
+            try:
+                for id, enqueued, payload in entries:
+                    current = id
+                    success = await db.add_data_for_devices_bulk(devices=payload["devices"],
+                                                                 external_events=payload["external_events"])
+                    if (isinstance(success, bool) and success is False) or (isinstance(success, int) and success == -1):
+                        raise ValueError("add_data_for_devices_bulk failed")
+                    done.append(id)
+
+                    lag = time.time() - enqueued
+                    self.metrics["drained"] += 1
+                    self.metrics["drain_lag"] = lag
+                    self.metrics["max_drain_lag"] = max(self.metrics["max_drain_lag"], lag)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                print(f"Ingest queue consumer failed on entry {current}: {error}")
+                self.metrics["failed"] += 1
+                # Only the entry that raised counts as an attempt, the ones after it were not tried
+                if await db.run(self.release, [entry[0] for entry in entries if entry[0] not in done], current,
+                                repr(error)):
+                    print(f"Moved ingest queue entry {current} to the dead letter table")
+                await asyncio.sleep(idle)
+            finally:
+                if done:
+                    await db.run(self.ack, done)
+
+    def get_metrics(self):
+        with self.lock:
+            connection = self.__connect__()
+            depth, oldest = connection.execute("SELECT COUNT(*), MIN(enqueued) FROM queue").fetchone()
+            dead_letters = connection.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+        metrics = dict(self.metrics)
+        metrics["depth"] = depth
+        metrics["max_size"] = self.max_size
+        metrics["dead_letters"] = dead_letters
+        metrics["oldest_age"] = time.time() - oldest if oldest is not None else 0.0
+        return metrics
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
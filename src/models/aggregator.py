@@ -14,5 +14,6 @@ class Aggregator(MongoModel):
     class Meta:
         indexes = [
             IndexModel([('token', DESCENDING)], unique=True),
-            IndexModel([('identifier', DESCENDING)], unique=True)
+            IndexModel([('identifier', DESCENDING)], unique=True),
+            IndexModel([('devices', DESCENDING)])
         ]
\ No newline at end of file
@@ -0,0 +1,9 @@
+from pymodm import MongoModel, fields
+
+
+class Counter(MongoModel):
+    """
+    Named integer shared by all processes, only ever changed with $inc
+    """
+    name = fields.CharField(primary_key=True)
+    value = fields.IntegerField(required=True, default=0)
@@ -16,6 +16,11 @@ class Category(MongoModel):
 class Data(MongoModel):
     key = fields.CharField(required=True)
     data = fields.DictField(required=True)
+    # Content hash of data and of each of its top-level entries, used to skip and narrow static data writes
+    hash = fields.CharField(required=False)
+    hashes = fields.DictField(required=False)
+    # Per-port min/max/mean/p95/rate of each live data rollup window, keyed like data
+    stats = fields.DictField(required=False)
 
 
 class Device(MongoModel):
@@ -44,3 +49,20 @@ class Filter(MongoModel):
                     ('value', DESCENDING)
                 ], unique=True)
         ]
+
+
+class SearchEntry(MongoModel):
+    """
+    One (key path, lowercased value) pair of a device's static data, maintained on write for filter_devices
+    """
+    device = fields.ReferenceField(Device, required=True, on_delete=ReferenceField.CASCADE)
+    data = fields.ObjectIdField(required=True)
+    key = fields.CharField(required=True)
+    value = fields.CharField(required=True)
+
+    class Meta:
+        indexes = [
+            IndexModel([('key', DESCENDING), ('value', DESCENDING), ('device', DESCENDING)]),
+            IndexModel([('data', DESCENDING)]),
+            IndexModel([('device', DESCENDING)])
+        ]
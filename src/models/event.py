@@ -1,24 +1,64 @@
 from datetime import datetime
 
 from pymodm import MongoModel, fields, ReferenceField
-from pymongo import IndexModel, DESCENDING
+from pymongo import IndexModel, ASCENDING, DESCENDING
 
 from src.models.device import Device
 
+# The archiver deletes expired events, the TTL index only removes what it left behind for a week
+EVENT_TTL_GRACE = 7 * 24 * 60 * 60
+
 
 class Event(MongoModel):
     timestamp = fields.DateTimeField(default=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
     event = fields.CharField(required=True)
     severity = fields.IntegerField(required=True, min_value=0, max_value=10)
     device = fields.ReferenceField(Device, ReferenceField.CASCADE)
+    # Set from the TTL of the severity band, events without it never expire
+    expires_at = fields.DateTimeField(required=False)
+    # Position in the event sequence shared by all processes, alert streams resume from it
+    sequence = fields.IntegerField(required=False)
 
     class Meta:
         indexes = [
+            IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=EVENT_TTL_GRACE),
+            IndexModel([('sequence', ASCENDING)]),
             IndexModel(
                 [
                     ('event', DESCENDING),
                     ('timestamp', DESCENDING),
                     ('device', DESCENDING)
-                ], unique=True)
+                ], unique=True),
+            IndexModel(
+                [
+                    ('device', DESCENDING),
+                    ('severity', DESCENDING),
+                    ('_id', DESCENDING)
+                ]),
+            IndexModel(
+                [
+                    ('device', DESCENDING),
+                    ('_id', DESCENDING)
+                ]),
+            IndexModel(
+                [
+                    ('severity', DESCENDING),
+                    ('_id', DESCENDING)
+                ])
         ]
 
+
+class EventCount(MongoModel):
+    # device is None for the global bucket of a severity
+    device = fields.ReferenceField(Device, ReferenceField.CASCADE, required=False)
+    severity = fields.IntegerField(required=True, min_value=0, max_value=10)
+    count = fields.IntegerField(required=True, default=0)
+
+    class Meta:
+        indexes = [
+            IndexModel(
+                [
+                    ('device', DESCENDING),
+                    ('severity', DESCENDING)
+                ], unique=True)
+        ]
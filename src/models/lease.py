@@ -0,0 +1,10 @@
+from pymodm import MongoModel, fields
+
+
+class Lease(MongoModel):
+    """
+    Named lock held by one process until expires, renewed by its owner while the guarded work runs
+    """
+    name = fields.CharField(primary_key=True)
+    owner = fields.CharField(required=True)
+    expires = fields.DateTimeField(required=True)
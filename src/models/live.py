@@ -0,0 +1,39 @@
+from pymodm import MongoModel, fields, ReferenceField
+from pymongo import IndexModel, DESCENDING
+
+from src.models.device import Device
+
+
+class LiveBucket(MongoModel):
+    """
+    Live counter rollups of one port of a device in the time span starting at start
+    """
+    device = fields.ReferenceField(Device, ReferenceField.CASCADE, required=True)
+    counter = fields.CharField(required=True)
+    port = fields.CharField(required=True, blank=True)
+    resolution = fields.CharField(required=True, default="raw")
+    start = fields.DateTimeField(required=True)
+    samples = fields.ListField(fields.DictField(), default=list)
+    count = fields.IntegerField(required=True, default=0)
+
+    class Meta:
+        indexes = [
+            IndexModel(
+                [
+                    ('device', DESCENDING),
+                    ('counter', DESCENDING),
+                    ('port', DESCENDING),
+                    ('resolution', DESCENDING),
+                    ('start', DESCENDING)
+                ], unique=True),
+            IndexModel(
+                [
+                    ('device', DESCENDING),
+                    ('start', DESCENDING)
+                ]),
+            IndexModel(
+                [
+                    ('resolution', DESCENDING),
+                    ('start', DESCENDING)
+                ])
+        ]
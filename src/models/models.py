@@ -136,6 +136,12 @@ class DeviceByIdOut(BaseModel):
     device: dict
 
 
+class LiveDataOut(BaseModel):
+    device: str
+    step: int = None
+    series: list
+
+
 class AggregatorByID(BaseModel):
     version: str = "0.0.0.0"
     ip: str = "1.2.3.4"
@@ -164,6 +170,7 @@ class GetAllDevicesOut(BaseModel):
     amount: int = None
     total: int = 123
     devices: list
+    next_cursor: str = None
 
 
 class GetAllAlertsOut(BaseModel):
@@ -171,6 +178,7 @@ class GetAllAlertsOut(BaseModel):
     amount: int = None
     total: int = 123
     alerts: list
+    next_cursor: str = None
 
 
 class AggregatorVersionIn(BaseModel):
@@ -8,6 +8,8 @@ from pymongo import IndexModel, DESCENDING
 class Node(MongoModel):
     hostname = fields.CharField(required=True)
     ip = fields.CharField(required=False)
+    # Content hash of the node's links as last reported, an unchanged report keeps the links and their connections
+    links_hash = fields.CharField(required=False)
 
     class Meta:
         indexes = [
@@ -22,11 +24,17 @@ class Link(MongoModel):
     vlans = fields.ListField(required=True, default=[{"id": 1, "name": "default"}])
     is_trunk = fields.BooleanField(required=True, default=False)
     node = fields.ReferenceField(Node, required=True, on_delete=ReferenceField.CASCADE)
+    # Set once the connection builder has paired the link
+    joined = fields.BooleanField(required=True, default=False)
+    # Stamped by a full connection rebuild
+    generation = fields.ObjectIdField(required=False)
 
     class Meta:
         indexes = [
             IndexModel([('description', DESCENDING), ("node", DESCENDING)], unique=True),
-            IndexModel([('description', DESCENDING), ("node", DESCENDING), ("remote_mac", DESCENDING)], unique=True)
+            IndexModel([('joined', DESCENDING)]),
+            IndexModel([('description', DESCENDING), ("node", DESCENDING), ("remote_mac", DESCENDING)], unique=True),
+            IndexModel([('mac', DESCENDING), ("remote_mac", DESCENDING)])
         ]
 
 
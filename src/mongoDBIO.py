@@ -1,39 +1,119 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import gzip
+import hashlib
 import json
+import os
+import re
+import socket
 
+import bson
+import numpy as np
 import pymodm
 import pymongo.errors
 import redis
 from decouple import config as dconfig
 from fastapi import HTTPException
 from pymodm import connection
-from pymongo import DESCENDING
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReturnDocument, UpdateOne, monitoring
 
 from bson import ObjectId
 
-from src.models.event import Event
+from src.models.event import Event, EventCount
 from src.models.aggregator import Aggregator
 from src.models.module import Type, Module
-from src.models.device import Device, Category, Data, Filter
+from src.models.device import Device, Category, Data, Filter, SearchEntry
 from src.models.node import Link, LinkJson, NodeJson, TreeJson, Connection, Node
+from src.models.lease import Lease
+from src.models.counter import Counter
+from src.models.live import LiveBucket
 
+from src.broker import EVENTS_CHANNEL, LIVE_CHANNEL
 from src.crypt import Crypt
+from src.cache import TTLCache
+from src.commandCounter import CommandCounter
 
 from bson import ObjectId
 
 import asyncio
+import threading
+import time
+
+# Registered before any MongoClient is created, listeners only apply to clients created afterwards
+command_counter = CommandCounter()
+monitoring.register(command_counter)
 
 
 # noinspection PyMethodMayBeStatic
 class MongoDBIO:
     def __init__(self, details):
         self.details = details
-        connection.connect(details)
+        # Connect lazily, so that constructing MongoDBIO before a fork does not share sockets with the children
+        connection.connect(details, connect=False)
         self.redis_indices = ["in_bytes", "in_unicast_packets", "in_non_unicast_packets",
                               "in_discards", "in_errors", "in_unknown_protocols",
                               "out_bytes", "out_unicast_packets", "out_non_unicast_packets",
                               "out_discards", "out_errors"]
         self.crypt = Crypt()
+        self.redis_clients = {}
+        self.redis_lock = threading.Lock()
+        self.redis_metrics = {"pipelines": 0, "pipeline_commands": 0, "max_pipeline_size": 0}
+        self.write_metrics = {"static_skipped": 0, "static_applied": 0, "static_fields_set": 0,
+                              "links_skipped": 0, "links_applied": 0}
+        self.rollup_interval = dconfig("rollup_interval", cast=int, default=30 * 60)
+        self.rollup_batch_size = dconfig("rollup_batch_size", cast=int, default=500)
+        # Last samples of every (device, port, counter) kept in a Redis list for the live feed backfill
+        self.live_ring_db = dconfig("live_ring_db", cast=int, default=len(self.redis_indices))
+        self.live_ring_size = dconfig("live_ring_size", cast=int, default=60)
+        self.live_ring_ttl = dconfig("live_ring_ttl", cast=int, default=60 * 60)
+        # Seconds of live counter history per LiveBucket document
+        self.live_bucket_span = dconfig("live_bucket_span", cast=int, default=24 * 60 * 60)
+
+        # Raw rollups are kept for retention_raw_days, hourly points for retention_hour_weeks, daily points forever
+        self.retention_interval = dconfig("retention_interval", cast=int, default=60 * 60)
+        self.retention_tiers = [
+            {"resolution": "raw", "step": None, "span": self.live_bucket_span,
+             "keep": dconfig("retention_raw_days", cast=int, default=7) * 24 * 60 * 60},
+            {"resolution": "hour", "step": 60 * 60, "span": 7 * 24 * 60 * 60,
+             "keep": dconfig("retention_hour_weeks", cast=int, default=8) * 7 * 24 * 60 * 60},
+            {"resolution": "day", "step": 24 * 60 * 60, "span": 28 * 24 * 60 * 60, "keep": None},
+        ]
+
+        # Days events of a severity band are kept before they are archived, as "low-high:days,..."
+        self.event_ttl = self.__parse_event_ttl__(dconfig("event_ttl", default="0-2:30,3-5:90,6-10:365"))
+        self.event_archive_path = dconfig("event_archive_path", default="./event_archive")
+        self.event_retention_interval = dconfig("event_retention_interval", cast=int, default=60 * 60)
+        # Events the counts exceeded the stored events by at the last check
+        self.event_count_excess = 0
+        self.rollup_metrics = {"runs": 0, "last_duration": 0.0, "max_duration": 0.0, "last_keys": 0,
+                               "last_samples": 0, "last_devices": 0}
+
+        cache_size = dconfig("cache_size", cast=int, default=1024)
+        cache_ttl = dconfig("cache_ttl", cast=int, default=60)
+        self.category_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.hostname_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.device_id_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.token_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.config_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.aggregator_etag_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Last config version this process saw, the shared one lives in the Counter collection
+        self.config_version = 0
+
+        self.connection_lock = threading.Lock()
+
+        # Materialized /api/tree graph, rebuilt when the topology version moves or the snapshot gets too old
+        self.tree_snapshot = None
+        self.tree_lock = threading.Lock()
+        self.tree_max_age = dconfig("tree_max_age", cast=int, default=60)
+
+        os.register_at_fork(after_in_child=self.__after_fork__)
+
+    def __after_fork__(self):
+        # MongoClient, redis connections and locks must not be shared with the parent process
+        connection.connect(self.details, connect=False)
+        self.redis_clients = {}
+        self.redis_lock = threading.Lock()
+        self.connection_lock = threading.Lock()
+        self.tree_lock = threading.Lock()
 
     def get_modules(self):
         modules = list(Module.objects.order_by([['type', DESCENDING]]).all())
@@ -51,8 +131,7 @@ class MongoDBIO:
 
         for t in types:
             t = t.to_son().to_dict()
-            t.pop("_id")
-            t["config"] = json.loads(self.crypt.decrypt(t["config"], dconfig("cryptokey")))
+            t["config"] = self.__decrypt_config__(t.pop("_id"), t["config"])
             typesDict.append(t)
         return typesDict
 
@@ -75,12 +154,14 @@ class MongoDBIO:
         devices.append(dev)
         ag.devices = devices
         ag.save()
+        self.__bump_config_version__()
 
         return ag
 
     def add_category(self, category: str):
         try:
             category = Category(category=category).save()
+            self.category_cache.clear()
             return category
         except Category.DuplicateKeyError:
             return False
@@ -89,6 +170,8 @@ class MongoDBIO:
         try:
             category = Category.objects.get({"_id": ObjectId(category_id)})
             category.delete()
+            self.category_cache.clear()
+            self.__bump_config_version__()
             return True
         except Category.DoesNotExist:
             return False
@@ -110,6 +193,8 @@ class MongoDBIO:
                 if len(modules) == 1:
                     Device.objects.raw({'_id': ObjectId(device_id)}).update({"$set": {"modules": []}})
                     modules[0].delete()
+                    self.config_cache.clear()
+                    self.__bump_config_version__()
                     return True
                 elif len(modules) == 0:
                     return False
@@ -126,12 +211,20 @@ class MongoDBIO:
 
                 device.modules = new_modules
                 device.save()
+                self.config_cache.clear()
+                self.__bump_config_version__()
         return True
 
 
     def get_category_by_category(self, category: str):
+        cached = self.category_cache.get(("category", category))
+        if cached is not None:
+            return cached
+
         try:
-            return Category.objects.get({"category": category})
+            cached = Category.objects.get({"category": category})
+            self.category_cache.set(("category", category), cached)
+            return cached
         except Category.DoesNotExist:
             return None
         except Category.MultipleObjectsReturned:
@@ -146,10 +239,16 @@ class MongoDBIO:
         if severity < 0 or severity > 10:
             return False
 
-        event = Event(device=device, severity=severity, event=event, timestamp=timestamp)
-        if self.check_if_event_exists(event) is False:
+        event = Event(device=device, severity=severity, event=event, timestamp=timestamp,
+                      expires_at=self.__event_expiry__(severity, timestamp),
+                      sequence=self.__next_event_sequence__(1))
+        try:
             event.save()
+        except pymongo.errors.DuplicateKeyError:
+            return event
 
+        self.__increment_event_counts__({(event.device.pk, severity): 1})
+        self.__publish_events__([event.to_son().to_dict()])
         return event
 
     def __is_float__(self, num: str):
@@ -175,8 +274,13 @@ class MongoDBIO:
             return False
 
     def check_token(self, token: str):
+        cached = self.token_cache.get(token)
+        if cached is not None:
+            return cached
+
         try:
             ag = Aggregator.objects.get({'token': token})
+            self.token_cache.set(token, ag)
             return ag
         except Aggregator.DoesNotExist:
             return False
@@ -200,13 +304,160 @@ class MongoDBIO:
         except Aggregator.MultipleObjectsReturned:
             return -1
 
+    def get_aggregator_config(self, id):
+        """
+        Assembles the config an aggregator polls in a constant number of queries
+        """
+        out = {"version": "", "ip": "", "devices": []}
+        aggregator = Aggregator._mongometa.collection.find_one({"_id": ObjectId(id)})
+        if aggregator is None:
+            return out
+
+        if aggregator.get("version"):
+            out["version"] = aggregator["version"]
+        if aggregator.get("ip"):
+            out["ip"] = aggregator["ip"]
+
+        device_ids = [device_id for device_id in aggregator.get("devices", []) if device_id is not None]
+        if not device_ids:
+            return out
+
+        devices = {}
+        for device in Device._mongometa.collection.find({"_id": {"$in": device_ids}}, {"static": 0, "live": 0}):
+            devices[device["_id"]] = device
+
+        categories = {}
+        missing = []
+        for device in devices.values():
+            if "category" in device and device["category"] is not None:
+                cached = self.category_cache.get(("id", device["category"]))
+                if cached is not None:
+                    categories[device["category"]] = cached.category
+                elif device["category"] not in missing:
+                    missing.append(device["category"])
+        if missing:
+            for category in Category._mongometa.collection.find({"_id": {"$in": missing}}):
+                categories[category["_id"]] = category["category"]
+
+        modules = {}
+        module_ids = []
+        for device in devices.values():
+            module_ids.extend(device.get("modules", []))
+        if module_ids:
+            for module in Module._mongometa.collection.find({"_id": {"$in": module_ids}}):
+                modules[module["_id"]] = module
+
+        types = {}
+        type_ids = [module["type"] for module in modules.values() if module.get("type") is not None]
+        type_ids.extend(type_id for type_id in aggregator.get("types", []) if type_id is not None)
+        if type_ids:
+            for type in Type._mongometa.collection.find({"_id": {"$in": type_ids}}):
+                types[type["_id"]] = type
+
+        for device_id in device_ids:
+            if device_id not in devices:
+                continue
+
+            d = dict(devices[device_id])
+            d["id"] = str(d.pop("_id"))
+            if "category" in d:
+                category = categories.get(d.pop("category"))
+                if category:
+                    # This has to be named typed. IDK why but just let it be
+                    d["type"] = category
+            d["timeout"] = 10
+
+            configs = []
+            for type_id in aggregator.get("types", []):
+                if type_id not in types:
+                    continue
+                t = types[type_id]
+
+                for module_id in devices[device_id].get("modules", []):
+                    m = modules.get(module_id)
+                    if m is None or m.get("type") not in types or types[m["type"]]["type"] != t["type"]:
+                        continue
+
+                    config = []
+                    if m.get("config") is not None:
+                        config = self.__decrypt_config__(t["_id"], t["config"]) | \
+                                 self.__decrypt_config__(m["_id"], m["config"], quoted=True)
+                    configs.append({"config": str(config), "_cls": m.get("_cls"), "id": str(m["_id"]),
+                                    "name": t["type"]})
+            d["modules"] = configs
+
+            out["devices"].append(d)
+        return out
+
+    def get_config_version(self):
+        """
+        Returns the config version shared by all worker processes, clears stale config caches
+        """
+        version = self.__read_counter__("config_version")
+        if version != self.config_version:
+            self.config_cache.clear()
+            self.aggregator_etag_cache.clear()
+            self.config_version = version
+        return version
+
+    def get_aggregator_config_etag(self, id, version: int):
+        """
+        Returns the ETag of the last config served to the aggregator if no config relevant write happened since
+        """
+        cached = self.aggregator_etag_cache.get(str(id))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        return None
+
+    def set_aggregator_config_etag(self, id, config: dict, version: int):
+        etag = '"' + hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest() + '"'
+        self.aggregator_etag_cache.set(str(id), (version, etag))
+        return etag
+
+    def __bump_config_version__(self):
+        self.__bump_counter__("config_version")
+
+    def __read_counter__(self, name: str):
+        counter = Counter._mongometa.collection.find_one({"_id": name})
+        return counter["value"] if counter is not None else 0
+
+    def __bump_counter__(self, name: str):
+        Counter._mongometa.collection.update_one(
+            {"_id": name},
+            {"$inc": {"value": 1}, "$set": {"_cls": Counter._mongometa.object_name}},
+            upsert=True)
+
     def get_hostname_from_device_id(self, id: str):
+        cached = self.device_id_cache.get(ObjectId(id))
+        if cached is not None:
+            return cached
+
         device = list(Device.objects.raw({"_id": ObjectId(id)}).only("hostname").all().values())
         if len(device) == 1:
+            self.device_id_cache.set(ObjectId(id), device[0]["hostname"])
             return device[0]["hostname"]
         return None
 
-    def get_device_by_id(self, id: str):
+    def get_hostnames_from_device_ids(self, ids: list):
+        hostnames = {}
+        missing = []
+        for id in set(ObjectId(id) for id in ids if id is not None):
+            cached = self.device_id_cache.get(id)
+            if cached is not None:
+                hostnames[str(id)] = cached
+            else:
+                missing.append(id)
+
+        if missing:
+            for device in Device.objects.raw({"_id": {"$in": missing}}).only("hostname").values():
+                self.device_id_cache.set(device["_id"], device["hostname"])
+                hostnames[str(device["_id"])] = device["hostname"]
+        return hostnames
+
+    def get_device_by_id(self, id: str, start: datetime = None, end: datetime = None, step: int = None):
+        """
+        Returns the device with resolved data, with start or end also the live history of that range
+        """
         try:
             id = ObjectId(id)
             device = Device.objects.get({'_id': id})
@@ -250,6 +501,8 @@ class MongoDBIO:
                 d["live"] = []
             if "modules" in d:
                 d["modules"] = modules
+            if start is not None or end is not None:
+                d["history"] = self.get_live_data(id, start=start, end=end, step=step)
 
             d.pop("_id")
             return d
@@ -285,7 +538,12 @@ class MongoDBIO:
     def get_category_by_id(self, id: str):
         try:
             id = ObjectId(id)
+            cached = self.category_cache.get(("id", id))
+            if cached is not None:
+                return cached
+
             category = Category.objects.get({'_id': id})
+            self.category_cache.set(("id", id), category)
             return category
         except Category.DoesNotExist:
             return None
@@ -301,7 +559,133 @@ class MongoDBIO:
         except Aggregator.MultipleObjectsReturned:
             return None
 
-    def get_device_by_category_full(self, categories: list = None, page: int = None, amount: int = None):
+    def get_device_by_category_full(self, categories: list = None, page: int = None, amount: int = None,
+                                    after: str = None):
+        """
+        Returns devices with category, static, live and module data resolved by a single aggregation pipeline
+        """
+        out = {}
+        query = {}
+        if categories:
+            query = {'category': {"$in": categories}}
+
+        out["page"] = page
+        out["amount"] = amount
+        out["total"] = Device.objects.raw(query).count()
+
+        devices = self.__paginate_devices__(query=query, page=page, amount=amount, after=after)
+        if devices == -1:
+            return -1
+        devices = list(devices.aggregate(*self.__device_full_pipeline__()))
+
+        out["next_cursor"] = None
+        if after is not None or (amount and page):
+            if amount and len(devices) == amount:
+                out["next_cursor"] = str(devices[-1]["_id"])
+
+        for device in devices:
+            device.pop("_id")
+        out["devices"] = devices
+        return out
+
+    def __paginate_devices__(self, query: dict, page: int = None, amount: int = None, after: str = None):
+        if after is not None:
+            # Keyset pagination: seek behind the last id of the previous page instead of skipping
+            query = dict(query)
+            query["_id"] = {"$lt": ObjectId(after)}
+            devices = Device.objects.raw(query).order_by([('_id', DESCENDING)])
+            if amount is not None and amount > 0:
+                devices = devices.limit(amount)
+            return devices
+
+        devices = Device.objects.raw(query).order_by([('_id', DESCENDING)])
+        if (page is not None and amount is not None) and (page > 0 and amount > 0):
+            return devices.skip((page - 1) * amount).limit(amount)
+        elif (page is None or page <= 0) and amount is None:
+            return devices
+        return -1
+
+    def __device_full_pipeline__(self):
+        return [
+            {"$lookup": {"from": Category._mongometa.collection_name, "localField": "category",
+                         "foreignField": "_id", "as": "category"}},
+            {"$lookup": {"from": Data._mongometa.collection_name, "localField": "static",
+                         "foreignField": "_id", "as": "static"}},
+            {"$lookup": {"from": Data._mongometa.collection_name, "localField": "live",
+                         "foreignField": "_id", "as": "live"}},
+            {"$lookup": {"from": Module._mongometa.collection_name, "localField": "modules",
+                         "foreignField": "_id", "as": "modules"}},
+            {"$lookup": {"from": Type._mongometa.collection_name, "localField": "modules.type",
+                         "foreignField": "_id", "as": "types"}},
+            {
+                "$project": {
+                    "_id": 1,
+                    "hostname": 1,
+                    "ip": 1,
+                    "category": {"$arrayElemAt": ["$category.category", 0]},
+                    "static": {"$map": {"input": "$static", "as": "s",
+                                        "in": {"key": "$$s.key", "data": "$$s.data"}}},
+                    "live": {"$map": {"input": "$live", "as": "l",
+                                      "in": {"key": "$$l.key", "data": "$$l.data"}}},
+                    "modules": {
+                        "$map": {
+                            "input": "$modules",
+                            "as": "m",
+                            "in": {
+                                "config": "$$m.config",
+                                "type": {
+                                    "$arrayElemAt": [
+                                        {
+                                            "$map": {
+                                                "input": {"$filter": {"input": "$types", "as": "t",
+                                                                      "cond": {"$eq": ["$$t._id", "$$m.type"]}}},
+                                                "as": "t",
+                                                "in": "$$t.type"
+                                            }
+                                        },
+                                        0
+                                    ]
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        ]
+
+    def export_devices(self, categories: list = None, full: bool = True, batch_size: int = 500):
+        """
+        Yields all devices, newest first, in lists of batch_size
+        """
+        query = {}
+        if categories:
+            query = {'category': {"$in": categories}}
+
+        if full:
+            pipeline = self.__device_full_pipeline__()
+        else:
+            pipeline = [
+                {"$lookup": {"from": Category._mongometa.collection_name, "localField": "category",
+                             "foreignField": "_id", "as": "category"}},
+                {"$project": {"_id": 1, "hostname": 1, "ip": 1,
+                              "category": {"$arrayElemAt": ["$category.category", 0]}}}
+            ]
+
+        devices = Device.objects.raw(query).order_by([('_id', DESCENDING)])
+        batch = []
+        for device in devices.aggregate(*pipeline, allowDiskUse=True, batchSize=batch_size):
+            device["id"] = str(device.pop("_id"))
+            batch.append(device)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def get_device_by_category_full_legacy(self, categories: list = None, page: int = None, amount: int = None):
+        """
+        Previous per-document implementation of get_device_by_category_full, kept for benchmark comparisons
+        """
         out = {}
         if categories:
             total = Device.objects.raw({'category': {"$in": categories}}).count()
@@ -337,10 +721,10 @@ class MongoDBIO:
             return -1
 
         devs = []
-        static = []
-        live = []
-        modules = []
         for d in devices:
+            static = []
+            live = []
+            modules = []
             if hasattr(d, "category"):
                 category = d.category.category
 
@@ -380,45 +764,26 @@ class MongoDBIO:
         out["devices"] = devs
         return out
 
-    def get_device_by_category(self, categories: list = None, page: int = None, amount: int = None):
+    def get_device_by_category(self, categories: list = None, page: int = None, amount: int = None,
+                               after: str = None):
         out = {}
+        query = {}
         if categories:
-            total = Device.objects.raw({'category': {"$in": categories}}).count()
-        else:
-            total = Device.objects.all().count()
+            query = {'category': {"$in": categories}}
+
         out["page"] = page
         out["amount"] = amount
-        out["total"] = total
+        out["total"] = Device.objects.raw(query).count()
 
-
-        if (page is not None and amount is not None) and (page > 0 and amount > 0):
-            if categories:
-                devices = list(Device.objects \
-                               .raw({'category': {"$in": categories}}) \
-                               .order_by([('_id', DESCENDING)]) \
-                               .skip((page - 1) * amount) \
-                               .limit(amount)
-                               .values())
-            else:
-                devices = list(Device.objects \
-                               .order_by([('_id', DESCENDING)]) \
-                               .skip((page - 1) * amount) \
-                               .limit(amount)
-                               .values())
-
-        elif (page is None or page <= 0) and amount is None:
-            if categories:
-                devices = list(Device.objects \
-                               .raw({'category': {"$in": categories}}) \
-                               .order_by([('_id', DESCENDING)])
-                               .values())
-            else:
-                devices = list(Device.objects \
-                               .order_by([('_id', DESCENDING)]) \
-                               .all()
-                               .values())
-        else:
+        devices = self.__paginate_devices__(query=query, page=page, amount=amount, after=after)
+        if devices == -1:
             return -1
+        devices = list(devices.values())
+
+        out["next_cursor"] = None
+        if after is not None or (amount and page):
+            if amount and len(devices) == amount:
+                out["next_cursor"] = str(devices[-1]["_id"])
 
         devs = []
         for d in devices:
@@ -507,39 +872,351 @@ class MongoDBIO:
                 self.__handle_events__(device=dev, events=external_events[hostname])
         return True
 
+    def add_data_for_devices_bulk(self, devices: list, external_events: dict):
+        """
+        Batched variant of add_data_for_devices, returns per-device results
+        """
+        commands = command_counter.count()
+        category = self.get_category_by_category("New")
+        if category is None:
+            category = self.add_category(category="New")
+
+        hostnames = []
+        for device in devices:
+            if "name" in device and device["name"] not in hostnames:
+                hostnames.append(device["name"])
+        for hostname in external_events:
+            if hostname not in hostnames:
+                hostnames.append(hostname)
+
+        results = {}
+        for hostname in hostnames:
+            results[hostname] = {"created": False, "static_updated": 0, "static_created": 0, "static_skipped": 0,
+                                 "events_inserted": 0, "events_duplicate": 0}
+
+        known = self.__find_devices_by_hostnames__(hostnames)
+
+        ips = {}
+        for device in devices:
+            if "name" in device and "ip" in device:
+                ips[device["name"]] = device["ip"]
+
+        inserted = self.__insert_devices__(hostnames, known, category, ips)
+        for hostname in inserted:
+            results[hostname]["created"] = True
+
+        static_ids = []
+        for document in known.values():
+            static_ids.extend(document.get("static", []))
+
+        static_keys = {}
+        static_hashes = {}
+        if static_ids:
+            projection = {"key": 1, "hash": 1, "hashes": 1}
+            for data in Data._mongometa.collection.find({"_id": {"$in": static_ids}}, projection):
+                static_keys[data["_id"]] = data["key"]
+                static_hashes[data["_id"]] = data
+
+        data_operations = []
+        device_operations = []
+        search_data = {}
+        events = []
+        event_owners = []
+        for device in devices:
+            if "name" not in device or device["name"] not in known:
+                continue
+
+            document = known[device["name"]]
+            result = results[device["name"]]
+
+            if "static_data" in device:
+                static_data = device["static_data"]
+                existing = {}
+                for data_id in document.get("static", []):
+                    if data_id in static_keys:
+                        existing[static_keys[data_id]] = data_id
+
+                created = []
+                for static_key in static_data:
+                    if static_key == "neighbors":
+                        interfaces = None
+                        if "vlan" in static_data:
+                            interfaces = static_data["vlan"]
+                        self.__handle_lldp_data__(links=static_data[static_key], device=device,
+                                                  interfaces=interfaces)
+                    elif isinstance(static_data[static_key], dict):
+                        input = self.__clean_dictionary__(static_data[static_key])
+                        if static_key in existing:
+                            update = self.__static_data_update__(static_hashes.get(existing[static_key], {}), input)
+                            if update is None:
+                                result["static_skipped"] += 1
+                                continue
+                            data_operations.append(UpdateOne({"_id": existing[static_key]}, update))
+                            result["static_updated"] += 1
+                        else:
+                            data_hash, hashes = self.__static_data_hashes__(input)
+                            self.write_metrics["static_applied"] += 1
+                            data = Data(key=static_key, data=input, hash=data_hash, hashes=hashes).to_son()
+                            data["_id"] = ObjectId()
+                            data_operations.append(InsertOne(data))
+                            created.append(data["_id"])
+                            existing[static_key] = data["_id"]
+                            result["static_created"] += 1
+                        search_data[existing[static_key]] = (document["_id"], input)
+
+                if created:
+                    device_operations.append(
+                        UpdateOne({"_id": document["_id"]}, {"$push": {"static": {"$each": created}}}))
+
+            if "live_data" in device:
+                self.redis_insert_live_data(device=Device.from_document(document), live_data=device["live_data"])
+
+            if "events" in device:
+                for event in self.__build_events__(device_id=document["_id"], events=device["events"]):
+                    events.append(event)
+                    event_owners.append(device["name"])
+
+        for hostname in external_events:
+            if hostname not in known:
+                continue
+            for event in self.__build_events__(device_id=known[hostname]["_id"], events=external_events[hostname]):
+                events.append(event)
+                event_owners.append(hostname)
+
+        if data_operations:
+            Data._mongometa.collection.bulk_write(data_operations, ordered=False)
+
+        if search_data:
+            self.__write_search_entries__(search_data)
+
+        if device_operations:
+            Device._mongometa.collection.bulk_write(device_operations, ordered=False)
+
+        if events:
+            sequence = self.__next_event_sequence__(len(events))
+            for offset, event in enumerate(events):
+                event["sequence"] = sequence + offset
+
+            duplicates = []
+            try:
+                Event._mongometa.collection.insert_many(events, ordered=False)
+            except pymongo.errors.BulkWriteError as bulk_error:
+                for error in bulk_error.details["writeErrors"]:
+                    if error["code"] != 11000:
+                        raise
+                    duplicates.append(error["index"])
+
+            counts = {}
+            inserted = []
+            for index, hostname in enumerate(event_owners):
+                if index in duplicates:
+                    results[hostname]["events_duplicate"] += 1
+                else:
+                    results[hostname]["events_inserted"] += 1
+                    bucket = (events[index]["device"], events[index]["severity"])
+                    counts[bucket] = counts.get(bucket, 0) + 1
+                    inserted.append(events[index])
+
+            if counts:
+                self.__increment_event_counts__(counts)
+            self.__publish_events__(inserted)
+
+        return {"round_trips": command_counter.count() - commands, "devices": results}
+
+    def __find_devices_by_hostnames__(self, hostnames: list, projection: dict = None):
+        devices = {}
+        if not hostnames:
+            return devices
+
+        if projection is None:
+            projection = {"hostname": 1, "static": 1, "_cls": 1}
+        for device in Device._mongometa.collection.find({"hostname": {"$in": hostnames}}, projection):
+            devices[device["hostname"]] = device
+        return devices
+
+    def __insert_devices__(self, hostnames: list, known: dict, category: Category, ips: dict = None,
+                           projection: dict = None):
+        """
+        Inserts the hostnames missing from known, returns the ones this call created
+        """
+        if ips is None:
+            ips = {}
+
+        new_devices = []
+        for hostname in hostnames:
+            if hostname not in known:
+                if hostname in ips:
+                    document = Device(hostname=hostname, category=category, ip=ips[hostname]).to_son()
+                else:
+                    document = Device(hostname=hostname, category=category).to_son()
+                document["_id"] = ObjectId()
+                new_devices.append(document)
+
+        if not new_devices:
+            return []
+
+        try:
+            Device._mongometa.collection.insert_many(new_devices, ordered=False)
+            inserted = new_devices
+        except pymongo.errors.BulkWriteError as bulk_error:
+            failed = [error["index"] for error in bulk_error.details["writeErrors"]]
+            inserted = [document for index, document in enumerate(new_devices) if index not in failed]
+
+            # Another request created some of the devices in the meantime
+            known.update(self.__find_devices_by_hostnames__(
+                [new_devices[index]["hostname"] for index in failed], projection))
+
+        for document in inserted:
+            known[document["hostname"]] = document
+        return [document["hostname"] for document in inserted]
+
+    def __build_events__(self, device_id: ObjectId, events: list):
+        documents = []
+        for event_dict in events:
+            timestamp = event_dict["timestamp"]
+            if self.__is_float__(num=str(timestamp)) is True:
+                timestamp = datetime.utcfromtimestamp(float(str(timestamp))).strftime('%Y-%m-%d %H:%M:%S')
+
+            severity = event_dict["severity"]
+            if severity < 0 or severity > 10:
+                continue
+
+            event = Event(device=device_id, severity=severity, event=event_dict["information"], timestamp=timestamp,
+                          expires_at=self.__event_expiry__(severity, timestamp))
+            documents.append(event.to_son())
+        return documents
+
     def __handle_static_data__(self, device: Device, key, input):
         for data in device.static:
             if data.key == key:
-                data.data = input
-                data.save()
+                update = self.__static_data_update__({"hash": data.hash, "hashes": data.hashes}, input)
+                if update is None:
+                    return
+                Data._mongometa.collection.update_one({"_id": data.pk}, update)
+                self.__write_search_entries__({data.pk: (device.pk, input)})
                 return
 
-        data = Data(key=key, data=input).save()
+        data_hash, hashes = self.__static_data_hashes__(input)
+        self.write_metrics["static_applied"] += 1
+        data = Data(key=key, data=input, hash=data_hash, hashes=hashes).save()
         data_list = device.static
         data_list.append(data)
         device.static = data_list
         device.save()
+        self.__write_search_entries__({data.pk: (device.pk, input)})
+
+    def __content_hash__(self, value):
+        return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def __static_data_hashes__(self, input: dict):
+        hashes = {}
+        for key in input:
+            hashes[key] = self.__content_hash__(input[key])
+        return self.__content_hash__(hashes), hashes
+
+    def __static_data_update__(self, stored: dict, input: dict):
+        """
+        Returns the update setting the changed top-level entries of input, None if nothing changed
+        """
+        data_hash, hashes = self.__static_data_hashes__(input)
+        if stored.get("hash") == data_hash:
+            self.write_metrics["static_skipped"] += 1
+            return None
 
-    def __handle_live_data__(self, device: Device, key, input):
-        for data in device.live:
-            if data.key == key:
-                new_data = input
-                old_data = data.data
+        self.write_metrics["static_applied"] += 1
+        old_hashes = stored.get("hashes")
+        safe = all(isinstance(key, str) and key and "." not in key and not key.startswith("$") for key in input)
+        if not isinstance(old_hashes, dict) or not safe:
+            self.write_metrics["static_fields_set"] += len(input)
+            return {"$set": {"data": input, "hash": data_hash, "hashes": hashes}}
+
+        update = {"$set": {"hash": data_hash}}
+        for key in input:
+            if old_hashes.get(key) != hashes[key]:
+                update["$set"][f"data.{key}"] = input[key]
+                update["$set"][f"hashes.{key}"] = hashes[key]
+                self.write_metrics["static_fields_set"] += 1
+
+        removed = {}
+        for key in old_hashes:
+            if key not in input:
+                removed[f"data.{key}"] = ""
+                removed[f"hashes.{key}"] = ""
+        if removed:
+            update["$unset"] = removed
+        return update
+
+    def get_write_metrics(self):
+        return dict(self.write_metrics)
+
+    def __flatten_static_data__(self, value, path: str = ""):
+        # Mirrors how MongoDB resolves a dotted path: dicts extend the path, lists match on each element
+        if isinstance(value, dict):
+            for key in value:
+                yield from self.__flatten_static_data__(value[key], f"{path}.{key}" if path else str(key))
+        elif isinstance(value, list):
+            for item in value:
+                yield from self.__flatten_static_data__(item, path)
+        elif isinstance(value, str) and path:
+            yield path, value.lower()
+
+    def __search_entries__(self, device_id: ObjectId, data_id: ObjectId, input: dict):
+        entries = set()
+        # Filters match below the first level of a static data document, e.g. interface -> mac_address
+        for value in input.values():
+            entries.update(self.__flatten_static_data__(value))
+
+        cls = SearchEntry._mongometa.object_name
+        return [{"_cls": cls, "device": device_id, "data": data_id, "key": key, "value": value}
+                for key, value in entries]
+
+    def __write_search_entries__(self, search_data: dict):
+        """
+        Replaces the search entries of {data_id: (device_id, input)}
+        """
+        entries = []
+        for data_id, (device_id, input) in search_data.items():
+            entries.extend(self.__search_entries__(device_id, data_id, input))
+
+        SearchEntry._mongometa.collection.delete_many({"data": {"$in": list(search_data.keys())}})
+        if entries:
+            SearchEntry._mongometa.collection.insert_many(entries, ordered=False)
+
+    def rebuild_search_index(self, batch_size: int = 1000):
+        """
+        Rebuilds the search entries of every device from its static data, returns the number of entries
+        """
+        SearchEntry._mongometa.collection.delete_many({})
+
+        total = 0
+        batch = []
+        devices = Device._mongometa.collection.find({"static.0": {"$exists": True}}, {"static": 1})
+        for device in devices:
+            batch.append(device)
+            if len(batch) == batch_size:
+                total += self.__rebuild_search_batch__(batch)
+                batch = []
+        if batch:
+            total += self.__rebuild_search_batch__(batch)
+        return total
 
-                updated_data = old_data | new_data
-                data.data = updated_data
+    def __rebuild_search_batch__(self, devices: list):
+        owners = {}
+        for device in devices:
+            for data_id in device.get("static", []):
+                if data_id is not None:
+                    owners[data_id] = device["_id"]
 
-                data.save()
-                return
+        search_data = {}
+        for data in Data._mongometa.collection.find({"_id": {"$in": list(owners.keys())}}, {"data": 1}):
+            search_data[data["_id"]] = (owners[data["_id"]], data.get("data", {}))
 
-        data = Data(key=key, data=input).save()
-        if hasattr(device, "live"):
-            data_list = device.live
-        else:
-            data_list = []
-        data_list.append(data)
-        device.live = data_list
-        device.save()
+        entries = []
+        for data_id, (device_id, input) in search_data.items():
+            entries.extend(self.__search_entries__(device_id, data_id, input))
+        if entries:
+            SearchEntry._mongometa.collection.insert_many(entries, ordered=False)
+        return len(entries)
 
     def __handle_events__(self, device: Device, events: list[{str, str}]):
         for event_dict in events:
@@ -576,7 +1253,9 @@ class MongoDBIO:
             return -1
 
         aggregator.version = ver
-        return aggregator.save()
+        aggregator = aggregator.save()
+        self.__bump_config_version__()
+        return aggregator
 
     def update_device(self, id: str, hostname: str = None, ip: str = None, category: str = None):
         if self.check_if_device_exists_by_id(id) is False:
@@ -595,6 +1274,8 @@ class MongoDBIO:
             update["category"] = ObjectId(category)
 
         Device.objects.raw({"_id": id}).update({"$set": update})
+        self.__invalidate_device_caches__()
+        self.__bump_config_version__()
         return True
 
     def update_category(self, id: str, category: str):
@@ -607,6 +1288,8 @@ class MongoDBIO:
         update = {"category": category}
         id = ObjectId(id)
         Category.objects.raw({"_id": id}).update({"$set": update})
+        self.category_cache.clear()
+        self.__bump_config_version__()
         return True
 
     def check_if_category_exists(self, category_id: str):
@@ -683,6 +1366,8 @@ class MongoDBIO:
             if is_obsolete:
                 type.delete()
 
+        self.config_cache.clear()
+        self.__bump_config_version__()
         return True
 
 
@@ -715,6 +1400,7 @@ class MongoDBIO:
                                 devices.append(device.pk)
                                 aggregator.devices = devices
                                 aggregator.save()
+                self.__bump_config_version__()
 
             return device
         return False
@@ -722,7 +1408,15 @@ class MongoDBIO:
     def delete_device_web(self, id):
         try:
             dev = Device.objects.get({'_id': id})
+            counts = {}
+            for bucket in EventCount._mongometa.collection.find({"device": dev.pk}):
+                counts[(None, bucket["severity"])] = -bucket["count"]
+
+            # Deleting the device cascades to its events and event count buckets
             dev.delete()
+            self.__increment_event_counts__(counts)
+            self.__invalidate_device_caches__()
+            self.__bump_config_version__()
             return True
         except Device.DoesNotExist:
             return False
@@ -744,22 +1438,41 @@ class MongoDBIO:
 
         config_out = []
 
-
         for t in ag.types:
             if hasattr(dev, "modules") and dev.modules:
                 for m in dev.modules:
-                    decrypted = json.loads(self.crypt.decrypt(t.config, dconfig("cryptokey")))
                     if t.type == m.type.type:
                         if m.config is not None:
-                            dv = self.crypt.decrypt(m.config, dconfig("cryptokey"))
-                            dv = dv.replace("'", '"')
-                            value = json.loads(dv)
-                            decrypted = decrypted | value
-                            m.config = decrypted
+                            decrypted = self.__decrypt_config__(t.pk, t.config)
+                            value = self.__decrypt_config__(m.pk, m.config, quoted=True)
+                            m.config = decrypted | value
                         config_out.append(m)
 
         return config_out
 
+    def decrypt_config(self, id, config: str):
+        """
+        Decrypts a Type or Module config, cached by document id and a hash of the encrypted content
+        """
+        key = ("raw", id, hashlib.sha1(config.encode("utf-8")).hexdigest())
+        decrypted = self.config_cache.get(key)
+        if decrypted is None:
+            decrypted = self.crypt.decrypt(config, dconfig("cryptokey"))
+            self.config_cache.set(key, decrypted)
+        return decrypted
+
+    def __decrypt_config__(self, id, config: str, quoted: bool = False):
+        key = ("json", id, hashlib.sha1(config.encode("utf-8")).hexdigest())
+        decrypted = self.config_cache.get(key)
+        if decrypted is None:
+            decrypted = self.decrypt_config(id, config)
+            if quoted:
+                # Module configs are stored as str(dict)
+                decrypted = decrypted.replace("'", '"')
+            decrypted = json.loads(decrypted)
+            self.config_cache.set(key, decrypted)
+        return dict(decrypted)
+
     def set_device_config(self, id, reqconfig):
         try:
             dev = Device.objects.get({'_id': id})
@@ -800,6 +1513,8 @@ class MongoDBIO:
         if modules:
             dev.modules = modules
             dev.save()
+        self.config_cache.clear()
+        self.__bump_config_version__()
         return True
 
     def delete_device_config(self, id, type):
@@ -813,6 +1528,8 @@ class MongoDBIO:
         for m in dev.modules:
             if m.type.type == type:
                 m.delete()
+                self.config_cache.clear()
+                self.__bump_config_version__()
                 return True
         return False
 
@@ -831,164 +1548,360 @@ class MongoDBIO:
     def get_event_by_id(self, event_id):
         try:
             event_id = ObjectId(event_id)
-            event = Event.objects.get({'_id': event_id})
+        except (pymongo.errors.InvalidId, TypeError):
+            return False
 
-            device = event.device
-            hostname = device.hostname
+        events = list(Event.objects.raw({'_id': event_id}).aggregate(
+            {"$lookup": {"from": Device._mongometa.collection_name, "localField": "device",
+                         "foreignField": "_id", "as": "device_document"}},
+            {"$addFields": {"hostname": {"$arrayElemAt": ["$device_document.hostname", 0]}}},
+            {"$project": {"device_document": 0}}
+        ))
+        if len(events) == 0:
+            return False
+        if len(events) > 1:
+            return -1
 
-            event = event.to_son().to_dict()
-            event["device_id"] = str(device.pk)
-            event["device"] = hostname
-            event["id"] = str(event.pop("_id"))
+        event = events[0]
+        event["device_id"] = str(event["device"])
+        event["device"] = event.pop("hostname", None)
+        event["id"] = str(event.pop("_id"))
+        if "_cls" in event:
             event.pop("_cls")
 
-            return event
-        except Event.DoesNotExist:
-            return False
-        except Event.MultipleObjectsReturned:
-            return -1
-        except pymongo.errors.InvalidId:
-            return False
+        return event
 
     def get_event_count(self, device_id: str = None, severities: list = None, min_severity: int = None):
+        """
+        Sums the materialized (device, severity) buckets of EventCount instead of counting Event documents
+        """
         if min_severity:
             severities = None
 
+        query = {"device": None}
         if device_id is not None:
-            device_id = ObjectId(device_id)
-            if severities:
-                total = Event.objects.raw({'device': device_id, "severity": {"$in": severities}}).count()
-            elif min_severity:
-                total = Event.objects.raw({'device': device_id, "severity": {"$gte": min_severity}}).count()
+            query["device"] = ObjectId(device_id)
+
+        if severities:
+            query["severity"] = {"$in": severities}
+        elif min_severity:
+            query["severity"] = {"$gte": min_severity}
+
+        result = list(EventCount._mongometa.collection.aggregate([
+            {"$match": query},
+            {"$group": {"_id": None, "total": {"$sum": "$count"}}}
+        ]))
+        if result:
+            return result[0]["total"]
+        return 0
+
+    def __increment_event_counts__(self, counts: dict):
+        """
+        Applies {(device_id, severity): delta} to the per device buckets and to the global bucket of each severity
+        """
+        deltas = {}
+        for (device_id, severity), delta in counts.items():
+            keys = [(None, severity)]
+            if device_id is not None:
+                keys.append((device_id, severity))
+            for key in keys:
+                deltas[key] = deltas.get(key, 0) + delta
+
+        operations = []
+        for (device_id, severity), delta in deltas.items():
+            if delta != 0:
+                operations.append(UpdateOne({"device": device_id, "severity": severity},
+                                            {"$inc": {"count": delta},
+                                             "$setOnInsert": {"_cls": EventCount._mongometa.object_name}},
+                                            upsert=True))
+        if operations:
+            EventCount._mongometa.collection.bulk_write(operations, ordered=False)
+
+    def reconcile_event_counts(self):
+        """
+        Rebuilds the EventCount store from the Event collection
+        """
+        before = {}
+        for bucket in EventCount._mongometa.collection.find({}, {"device": 1, "severity": 1, "count": 1}):
+            before[(bucket.get("device"), bucket["severity"])] = bucket["count"]
+
+        buckets = {}
+        for bucket in Event.objects.aggregate(
+                {"$group": {"_id": {"device": "$device", "severity": "$severity"}, "count": {"$sum": 1}}},
+                allowDiskUse=True):
+            device_id = bucket["_id"]["device"]
+            severity = bucket["_id"]["severity"]
+            buckets[(device_id, severity)] = bucket["count"]
+            buckets[(None, severity)] = buckets.get((None, severity), 0) + bucket["count"]
+
+        operations = []
+        for device_id, severity in set(buckets) | set(before):
+            delta = buckets.get((device_id, severity), 0) - before.get((device_id, severity), 0)
+            if delta != 0:
+                operations.append(UpdateOne({"device": device_id, "severity": severity},
+                                            {"$inc": {"count": delta},
+                                             "$setOnInsert": {"_cls": EventCount._mongometa.object_name}},
+                                            upsert=True))
+        if operations:
+            EventCount._mongometa.collection.bulk_write(operations, ordered=False)
+
+        stale = [{"device": device_id, "severity": severity} for device_id, severity in before
+                 if (device_id, severity) not in buckets]
+        if stale:
+            # Unless an event of the bucket was stored meanwhile
+            EventCount._mongometa.collection.delete_many({"$or": stale, "count": 0})
+
+        return len(buckets)
+
+    # --- Event retention --- #
+
+    def __parse_event_ttl__(self, value: str):
+        bands = []
+        for band in value.split(","):
+            if not band.strip():
+                continue
+            severities, days = band.split(":")
+            low, _, high = severities.partition("-")
+            bands.append((int(low), int(high or low), int(days)))
+        return bands
+
+    def __event_time__(self, timestamp):
+        if isinstance(timestamp, datetime):
+            return timestamp
+        try:
+            return datetime.strptime(str(timestamp), '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(str(timestamp))
+        except ValueError:
+            return datetime.now()
+
+    def __event_expiry__(self, severity: int, timestamp):
+        for low, high, days in self.event_ttl:
+            if low <= severity <= high:
+                # Events that are already past their TTL go to the next archive run, never straight to the TTL index
+                return max(self.__event_time__(timestamp) + timedelta(days=days), datetime.now())
+        return None
+
+    def stamp_event_expiry(self, restamp: bool = False, batch_size: int = 1000):
+        """
+        Sets expires_at on events stored without one, returns the number of updated events
+        """
+        query = {}
+        if not restamp:
+            # Severities no band covers never get an expiry, they would match again on every run
+            covered = [severity for low, high, _ in self.event_ttl for severity in range(low, high + 1)]
+            query = {"expires_at": {"$exists": False}, "severity": {"$in": covered}}
+        updated = 0
+        operations = []
+        for event in Event._mongometa.collection.find(query, {"severity": 1, "timestamp": 1}).batch_size(batch_size):
+            expires_at = self.__event_expiry__(event["severity"], event.get("timestamp"))
+            if expires_at is None:
+                operations.append(UpdateOne({"_id": event["_id"]}, {"$unset": {"expires_at": ""}}))
             else:
-                total = Event.objects.raw({'device': device_id}).count()
+                operations.append(UpdateOne({"_id": event["_id"]}, {"$set": {"expires_at": expires_at}}))
+            if len(operations) == batch_size:
+                Event._mongometa.collection.bulk_write(operations, ordered=False)
+                updated += len(operations)
+                operations = []
+        if operations:
+            Event._mongometa.collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+        return updated
+
+    def archive_expired_events(self, batch_size: int = 1000):
+        """
+        Moves events past expires_at into a gzip compressed NDJSON file below event_archive_path
+        """
+        now = datetime.now()
+        query = {"expires_at": {"$lte": now}}
+        if Event._mongometa.collection.find_one(query, {"_id": 1}) is None:
+            self.__check_event_counts__()
+            return {"archived": 0, "file": None}
+
+        os.makedirs(self.event_archive_path, exist_ok=True)
+        path = os.path.join(self.event_archive_path, f"events-{now.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.ndjson.gz")
+
+        archived = 0
+        with gzip.open(path, "wt", encoding="utf-8") as file:
+            while True:
+                events = list(Event._mongometa.collection.find(query).sort("_id", 1).limit(batch_size))
+                if not events:
+                    break
+
+                hostnames = self.get_hostnames_from_device_ids([event.get("device") for event in events])
+                for event in events:
+                    file.write(json.dumps({
+                        "id": str(event["_id"]),
+                        "event": event["event"],
+                        "severity": event["severity"],
+                        "timestamp": event["timestamp"].isoformat() if isinstance(event.get("timestamp"), datetime)
+                        else event.get("timestamp"),
+                        "device_id": str(event["device"]) if event.get("device") is not None else None,
+                        "device": hostnames.get(str(event.get("device")))
+                    }) + "\n")
+                # The batch is on disk before it leaves the database, a crash here archives it twice at worst
+                file.flush()
+                os.fsync(file.fileno())
+
+                Event._mongometa.collection.delete_many({"_id": {"$in": [event["_id"] for event in events]}})
+                counts = {}
+                for event in events:
+                    bucket = (event.get("device"), event["severity"])
+                    counts[bucket] = counts.get(bucket, 0) - 1
+                self.__increment_event_counts__(counts)
+                archived += len(events)
+
+        self.__check_event_counts__()
+        return {"archived": archived, "file": path}
+
+    def __check_event_counts__(self):
+        """
+        Rebuilds the event counts once they exceeded the stored events in two checks in a row
+        """
+        total = 0
+        for bucket in EventCount._mongometa.collection.find({"device": None}, {"count": 1}):
+            total += bucket["count"]
+        excess = total - Event._mongometa.collection.count_documents({})
+        if excess > 0 and self.event_count_excess > 0:
+            print(f"Event counts exceed the stored events by {excess}, reconciling")
+            self.reconcile_event_counts()
+            excess = 0
+        self.event_count_excess = max(excess, 0)
+
+    def restore_events(self, path: str):
+        """
+        Inserts the events of an archive file or directory back under their original ids
+        """
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".ndjson.gz"))
         else:
-            if severities:
-                total = Event.objects.raw({"severity": {"$in": severities}}).count()
-            elif min_severity:
-                total = Event.objects.raw({"severity": {"$gte": min_severity}}).count()
+            files = [path]
+
+        result = {"restored": 0, "present": 0, "skipped": 0}
+        now = datetime.now()
+        for file_path in files:
+            with gzip.open(file_path, "rt", encoding="utf-8") as file:
+                batch = []
+                for line in file:
+                    if line.strip():
+                        batch.append(json.loads(line))
+                    if len(batch) == 1000:
+                        self.__restore_event_batch__(batch, now, result)
+                        batch = []
+                if batch:
+                    self.__restore_event_batch__(batch, now, result)
+        return result
+
+    def __restore_event_batch__(self, batch: list, now: datetime, result: dict):
+        device_ids = set()
+        for entry in batch:
+            if entry.get("device_id"):
+                device_ids.add(ObjectId(entry["device_id"]))
+        devices = {device["_id"] for device in Device._mongometa.collection.find({"_id": {"$in": list(device_ids)}},
+                                                                                 {"_id": 1})}
+        by_hostname = self.__find_devices_by_hostnames__(
+            [entry["device"] for entry in batch if entry.get("device")], {"hostname": 1})
+
+        events = []
+        for entry in batch:
+            device_id = ObjectId(entry["device_id"]) if entry.get("device_id") else None
+            if device_id not in devices:
+                # The device was deleted and maybe added again under the same hostname
+                if entry.get("device") not in by_hostname:
+                    result["skipped"] += 1
+                    continue
+                device_id = by_hostname[entry["device"]]["_id"]
+
+            event = Event(device=device_id, severity=entry["severity"], event=entry["event"],
+                          timestamp=self.__event_time__(entry["timestamp"]),
+                          expires_at=self.__event_expiry__(entry["severity"], now)).to_son()
+            event["_id"] = ObjectId(entry["id"])
+            events.append(event)
+
+        if not events:
+            return
+
+        duplicates = []
+        try:
+            Event._mongometa.collection.insert_many(events, ordered=False)
+        except pymongo.errors.BulkWriteError as bulk_error:
+            for error in bulk_error.details["writeErrors"]:
+                if error["code"] != 11000:
+                    raise
+                duplicates.append(error["index"])
+
+        counts = {}
+        for index, event in enumerate(events):
+            if index in duplicates:
+                result["present"] += 1
             else:
-                total = Event.objects.all().count()
-        return total
+                result["restored"] += 1
+                bucket = (event["device"], event["severity"])
+                counts[bucket] = counts.get(bucket, 0) + 1
+        if counts:
+            self.__increment_event_counts__(counts)
+
+    async def keep_event_retention(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.event_retention_interval)
+            result = await loop.run_in_executor(None, self.archive_expired_events)
+            if result["archived"]:
+                print(f"Archived {result['archived']} expired events to {result['file']}")
 
     def get_events(self, amount: int = None, page: int = None, severities: list = None, min_severity: int = None,
-                   device_id: str = None):
+                   device_id: str = None, after: str = None):
         if device_id is not None:
             device_id = ObjectId(device_id)
 
         if (amount is not None and amount <= 0) or (page is not None and page < 0) or (min_severity is not None and min_severity < 0):
             return False
 
-        if min_severity is not None:
-            severity = None
-
         if min_severity is not None and min_severity > 10:
             return False
 
-        if amount is not None and page is not None:
-            if min_severity is not None:
-                if device_id is not None:
-                    events = list(
-                        Event.objects
-                            .raw({'device': device_id, "severity": {"$gte": min_severity}})
-                            .order_by([('_id', DESCENDING)])
-                            .skip((page - 1) * amount)
-                            .limit(amount)
-                            .values()
-                    )
-                else:
-                    events = list(
-                        Event.objects
-                            .raw({"severity": {"$gte": min_severity}})
-                            .order_by([('_id', DESCENDING)])
-                            .skip((page - 1) * amount)
-                            .limit(amount)
-                            .values()
-                    )
-            elif severities is not None:
-                if device_id is not None:
-                    events = list(
-                        Event.objects
-                            .raw({'device': device_id, "severity": {"$in": severities}})
-                            .order_by([('_id', DESCENDING)])
-                            .skip((page - 1) * amount)
-                            .limit(amount)
-                            .values()
-                    )
-                else:
-                    events = list(
-                        Event.objects
-                            .raw({"severity": {"$in": severities}})
-                            .order_by([('_id', DESCENDING)])
-                            .skip((page - 1) * amount)
-                            .limit(amount)
-                            .values()
-                    )
-            elif device_id is not None:
-                events = list(
-                    Event.objects
-                        .raw({'device': device_id})
-                        .order_by([('_id', DESCENDING)])
-                        .skip((page - 1) * amount)
-                        .limit(amount)
-                        .values()
-                )
-            else:
-                events = list(
-                    Event.objects
-                        .order_by([('_id', DESCENDING)])
-                        .skip((page - 1) * amount)
-                        .limit(amount)
-                        .values()
-                )
-        else:
-            if min_severity is not None:
-                if device_id is not None:
-                    events = list(
-                        Event.objects
-                            .raw({'device': device_id, "severity": {"$gte": min_severity}})
-                            .order_by([('_id', DESCENDING)])
-                            .values()
-                    )
-                else:
-                    events = list(
-                        Event.objects
-                            .raw({"severity": {"$gte": min_severity}})
-                            .order_by([('_id', DESCENDING)])
-                            .values()
-                    )
-            elif severities is not None:
-                if device_id is not None:
-                    events = list(
-                        Event.objects
-                            .raw({'device': device_id, "severity": {"$in": severities}})
-                            .order_by([('_id', DESCENDING)])
-                            .values()
-                    )
-                else:
-                    events = list(
-                        Event.objects
-                            .raw({"severity": {"$in": severities}})
-                            .order_by([('_id', DESCENDING)])
-                            .values()
-                    )
-            elif device_id is not None:
-                events = list(
-                    Event.objects
-                        .raw({'device': device_id})
-                        .order_by([('_id', DESCENDING)])
-                        .values()
-                )
-            else:
-                events = list(
-                    Event.objects
-                        .order_by([('_id', DESCENDING)])
-                        .all()
-                        .values()
-                )
+        query = self.__event_query__(device_id=device_id, severities=severities, min_severity=min_severity)
+        if after is not None:
+            # Keyset pagination: seek behind the last id of the previous page instead of skipping
+            query["_id"] = {"$lt": ObjectId(after)}
+
+        events = Event.objects.raw(query).order_by([('_id', DESCENDING)])
+        if after is not None:
+            if amount is not None:
+                events = events.limit(amount)
+        elif amount is not None and page is not None:
+            events = events.skip((page - 1) * amount).limit(amount)
+
+        return self.__format_events__(list(events.values()))
+
+    def export_events(self, severities: list = None, min_severity: int = None, device_id: str = None,
+                      batch_size: int = 1000):
+        """
+        Yields all matching events, newest first, in lists of batch_size read from one cursor
+        """
+        if device_id is not None:
+            device_id = ObjectId(device_id)
+        query = self.__event_query__(device_id=device_id, severities=severities, min_severity=min_severity)
+
+        cursor = Event._mongometa.collection.find(Event.objects.raw(query).raw_query)
+        cursor = cursor.sort("_id", DESCENDING).batch_size(batch_size)
+        batch = []
+        for event in cursor:
+            batch.append(event)
+            if len(batch) == batch_size:
+                yield self.__format_events__(batch)
+                batch = []
+        if batch:
+            yield self.__format_events__(batch)
+
+    def __format_events__(self, events: list):
+        hostnames = self.get_hostnames_from_device_ids([event["device"] for event in events])
 
         events_cleansed = []
         for event in events:
+            event = dict(event)
 
             event["id"] = str(event.pop("_id"))
             if "_cls" in event:
@@ -996,12 +1909,59 @@ class MongoDBIO:
             event["timestamp"] = str(event["timestamp"])
             event["device_id"] = str(event.pop("device"))
 
-            event["device"] = str(self.get_hostname_from_device_id(event["device_id"]))
+            event["device"] = str(hostnames.get(event["device_id"]))
 
             events_cleansed.append(event)
 
         return events_cleansed
 
+    def get_events_since(self, after: int, min_severity: int = None, device_id: str = None, amount: int = 1000):
+        """
+        Returns up to amount events with a sequence above after, in sequence order, to resume an alert stream
+        """
+        if device_id is not None:
+            device_id = ObjectId(device_id)
+        query = self.__event_query__(device_id=device_id, min_severity=min_severity)
+        query["sequence"] = {"$gt": after}
+
+        events = Event.objects.raw(query).order_by([('sequence', ASCENDING)]).limit(amount)
+        return self.__format_events__(list(events.values()))
+
+    def __next_event_sequence__(self, amount: int):
+        """
+        Reserves amount numbers of the event sequence shared by all processes, returns the first one
+        """
+        counter = Counter._mongometa.collection.find_one_and_update(
+            {"_id": "event_sequence"},
+            {"$inc": {"value": amount}, "$set": {"_cls": Counter._mongometa.object_name}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        return counter["value"] - amount + 1
+
+    def __publish_events__(self, events: list):
+        """
+        Announces newly stored events on the Redis events channel, the Broker of every process fans them out
+        """
+        if not events:
+            return
+        try:
+            pipeline = self.__get_redis__(0).pipeline(transaction=False)
+            for event in self.__format_events__(events):
+                pipeline.publish(EVENTS_CHANNEL, json.dumps(event, default=str))
+            self.__execute_pipeline__(pipeline)
+        except redis.RedisError as error:
+            print(f"Could not publish events: {error}")
+
+    def __event_query__(self, device_id: ObjectId = None, severities: list = None, min_severity: int = None):
+        query = {}
+        if device_id is not None:
+            query["device"] = device_id
+
+        if min_severity is not None:
+            query["severity"] = {"$gte": min_severity}
+        elif severities is not None:
+            query["severity"] = {"$in": severities}
+        return query
+
     def checkInt(self, input: str):
         try:
             int(input)
@@ -1033,28 +1993,107 @@ class MongoDBIO:
     async def keep_connections(self):
         while True:
             await asyncio.sleep(10)
-            print("Connections thread started")
-
-            links = list(Link.objects.order_by([['mac', DESCENDING]]).all())
-
-            for source in links:
-                try:
-                    query = {
-                        "mac": f"{source.remote_mac}",
-                        "remote_mac": f"{source.mac}"
-                    }
-                    target = Link.objects.get(query)
-                except Link.DoesNotExist:
-                    continue
-                except Link.MultipleObjectsReturned:
-                    continue
-
-                print("Connection found")
-                connection = Connection(source=source, target=target)
-                if self.__check_if_connection_exists__(connection=connection) is False:
-                    connection.save()
-
-
+            created = await asyncio.get_running_loop().run_in_executor(None, self.build_connections)
+            if created:
+                print(f"Connections thread created {created} connections")
+
+    def build_connections(self, full: bool = False, batch_size: int = 1000):
+        """
+        Pairs unjoined links, full also rejoins every link, returns the number of created connections
+        """
+        with self.connection_lock:
+            links = Link._mongometa.collection
+            if full:
+                self.__drop_stale_connections__(batch_size)
+                links.update_many({}, {"$set": {"joined": False}})
+
+            created = 0
+            while True:
+                # Links are saved unjoined by whichever worker process received the report, links saved before the
+                # joined flag existed have no value and are joined once as well
+                changed = list(links.find({"joined": {"$ne": True}}, {"mac": 1, "remote_mac": 1}).limit(batch_size))
+                if not changed:
+                    return created
+
+                created += self.__join_links__([link for link in changed if link.get("remote_mac")])
+                # Flagged only after their connections are saved, a failed run picks the same links up again
+                links.update_many({"_id": {"$in": [link["_id"] for link in changed]}}, {"$set": {"joined": True}})
+
+    def __drop_stale_connections__(self, batch_size: int = 1000):
+        """
+        Deletes the connections whose source or target link no longer exists
+        """
+        links = Link._mongometa.collection
+        connections = Connection._mongometa.collection
+
+        # Every link existing now carries the generation of this run, a connection end without it was deleted
+        generation = ObjectId()
+        links.update_many({}, {"$set": {"generation": generation}})
+
+        stale = []
+        batch = []
+        for connection in connections.find({}, {"source": 1, "target": 1}).batch_size(batch_size):
+            batch.append(connection)
+            if len(batch) == batch_size:
+                stale.extend(self.__unstamped_connections__(batch, generation))
+                batch = []
+        stale.extend(self.__unstamped_connections__(batch, generation))
+
+        for start in range(0, len(stale), batch_size):
+            connections.delete_many({"_id": {"$in": stale[start:start + batch_size]}})
+        if stale:
+            self.__bump_topology_version__()
+
+    def __unstamped_connections__(self, batch: list, generation: ObjectId):
+        if not batch:
+            return []
+        ends = list({connection[end] for connection in batch for end in ("source", "target")})
+        stamped = {link["_id"] for link in Link._mongometa.collection.find(
+            {"_id": {"$in": ends}, "generation": generation}, {"_id": 1})}
+        return [connection["_id"] for connection in batch
+                if connection["source"] not in stamped or connection["target"] not in stamped]
+
+    def __join_links__(self, changed: list):
+        """
+        Saves the missing connections of the given links, returns how many were created
+        """
+        links = Link._mongometa.collection
+        if not changed:
+            return 0
+
+        # Hash join on (mac, remote_mac), a key matching more than one link is ambiguous and skipped
+        candidates = {}
+        for link in links.find({"mac": {"$in": list({link["remote_mac"] for link in changed})},
+                                "remote_mac": {"$in": list({link["mac"] for link in changed})}},
+                               {"mac": 1, "remote_mac": 1}):
+            key = (link["mac"], link["remote_mac"])
+            candidates[key] = None if key in candidates else link["_id"]
+
+        pairs = []
+        for link in changed:
+            target = candidates.get((link["remote_mac"], link["mac"]))
+            if target is not None and target != link["_id"]:
+                pairs.append((link["_id"], target))
+        if not pairs:
+            return 0
+
+        ids = list({link_id for pair in pairs for link_id in pair})
+        existing = set()
+        for connection in Connection._mongometa.collection.find(
+                {"$or": [{"source": {"$in": ids}}, {"target": {"$in": ids}}]}, {"source": 1, "target": 1}):
+            existing.add(frozenset((connection["source"], connection["target"])))
+
+        new_connections = []
+        for source, target in pairs:
+            pair = frozenset((source, target))
+            if pair not in existing:
+                existing.add(pair)
+                new_connections.append(Connection(source=source, target=target).to_son())
+
+        if new_connections:
+            Connection._mongometa.collection.insert_many(new_connections)
+            self.__bump_topology_version__()
+        return len(new_connections)
 
     def __create_connections__(self, source: Link):
         try:
@@ -1073,11 +2112,22 @@ class MongoDBIO:
             connection.save()
 
     def get_device_id_from_hostname(self, hostname: str):
+        cached = self.hostname_cache.get(hostname)
+        if cached is not None:
+            return cached
+
         device = list(Device.objects.raw({"hostname": hostname}).only("_id").all().values())
         if len(device) == 1:
+            self.hostname_cache.set(hostname, ObjectId(device[0]["_id"]))
             return ObjectId(device[0]["_id"])
         return None
 
+    def __invalidate_device_caches__(self):
+        self.hostname_cache.clear()
+        self.device_id_cache.clear()
+        # Tree nodes carry the device id of their hostname
+        self.__bump_topology_version__()
+
     def get_connection_by_source(self, source_id: ObjectId):
         try:
             connection = Connection.objects.get({"source": source_id})
@@ -1097,65 +2147,148 @@ class MongoDBIO:
             return None
 
     def get_tree(self, vlan_id: int = None):
-        connections = []
-        if vlan_id:
-            valid_links = []
-            links = list(Link.objects.only("_id").only("vlans").values())
-            for link in links:
-                if "vlans" in link:
-                    for vlan in link["vlans"]:
-                        if isinstance(vlan, dict) is False:
-                            try:
-                                vlan = json.loads(vlan)
-                            finally:
-                                continue
+        return self.get_tree_view(vlan_id)["tree"]
 
-                        if "id" in vlan and vlan["id"] == vlan_id:
-                            valid_links.append(link)
+    def get_topology_version(self):
+        return self.__read_counter__("topology_version")
 
-            for link in valid_links:
-                connection = self.get_connection_by_source(source_id=link["_id"])
-                if connection is None:
-                    connection = self.get_connection_by_target(target_id=link["_id"])
+    def __bump_topology_version__(self):
+        self.__bump_counter__("topology_version")
 
-                if connection:
-                    connections.append(connection)
+    def get_tree_view(self, vlan_id: int = None, topology_version: int = None):
+        """
+        Returns {"tree", "json", "etag"} for the whole topology or a single VLAN from the materialized snapshot
+        """
+        if topology_version is None:
+            topology_version = self.get_topology_version()
+        snapshot = self.__get_tree_snapshot__(topology_version)
+        view = snapshot["views"].get(vlan_id)
+        if view is not None:
+            return view
 
+        if vlan_id:
+            edges = [snapshot["edges"][i] for i in snapshot["vlan_edges"].get(vlan_id, [])]
         else:
-            connections = Connection.objects.all()
+            edges = snapshot["edges"]
 
         links = []
-        nodes = []
+        nodes = {}
+        for source, target in edges:
+            links.append(LinkJson(source=source, target=target))
+            nodes[source] = snapshot["nodes"][source]
+            nodes[target] = snapshot["nodes"][target]
+
+        tree = TreeJson(links=links, nodes=list(nodes.values()))
+        body = tree.json()
+        view = {
+            "tree": tree,
+            "json": body,
+            "etag": '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+        }
+        snapshot["views"][vlan_id] = view
+        return view
+
+    def get_tree_etag(self, topology_version: int, vlan_id: int = None):
+        """
+        Returns the ETag of a tree view if it can be served from the current snapshot without a rebuild
+        """
+        snapshot = self.tree_snapshot
+        if snapshot is None or self.__tree_snapshot_stale__(snapshot, topology_version):
+            return None
+        view = snapshot["views"].get(vlan_id)
+        if view is None:
+            return None
+        return view["etag"]
+
+    def __tree_snapshot_stale__(self, snapshot: dict, topology_version: int):
+        return snapshot["topology_version"] != topology_version or \
+            time.monotonic() - snapshot["built"] > self.tree_max_age
+
+    def __get_tree_snapshot__(self, topology_version: int):
+        snapshot = self.tree_snapshot
+        if snapshot is not None and not self.__tree_snapshot_stale__(snapshot, topology_version):
+            return snapshot
+
+        with self.tree_lock:
+            snapshot = self.tree_snapshot
+            if snapshot is None or self.__tree_snapshot_stale__(snapshot, topology_version):
+                snapshot = self.__build_tree_snapshot__(topology_version)
+                self.tree_snapshot = snapshot
+            return snapshot
+
+    def __build_tree_snapshot__(self, topology_version: int):
+        """
+        Loads connections, links, nodes and device ids with one query per collection and indexes the edges by VLAN
+        """
+
+        connections = list(Connection._mongometa.collection.find({}, {"source": 1, "target": 1}))
+        link_ids = list({link_id for connection in connections
+                         for link_id in (connection.get("source"), connection.get("target")) if link_id is not None})
+        links = {}
+        if link_ids:
+            for link in Link._mongometa.collection.find({"_id": {"$in": link_ids}}, {"node": 1, "vlans": 1}):
+                links[link["_id"]] = link
+
+        node_ids = list({link["node"] for link in links.values() if link.get("node") is not None})
+        hostnames = {}
+        if node_ids:
+            for node in Node._mongometa.collection.find({"_id": {"$in": node_ids}}, {"hostname": 1}):
+                hostnames[node["_id"]] = node["hostname"]
+
+        device_ids = {}
+        if hostnames:
+            for device in Device._mongometa.collection.find({"hostname": {"$in": list(set(hostnames.values()))}},
+                                                            {"hostname": 1}):
+                # Hostnames shared by several devices resolve to no device, like get_device_id_from_hostname
+                device_ids[device["hostname"]] = None if device["hostname"] in device_ids else device["_id"]
+
+        nodes = {}
+        edges = []
+        adjacency = {}
+        vlan_edges = {}
+        seen = set()
         for connection in connections:
-            source_link = connection.source
-            source_node = source_link.node
-            target_link = connection.target
-            target_node = target_link.node
-            source_device_id = self.get_device_id_from_hostname(source_node.hostname)
-            target_device_id = self.get_device_id_from_hostname(target_node.hostname)
-
-            links.append(
-                LinkJson(
-                    source=source_node.hostname,
-                    target=target_node.hostname,
-                )
-            )
+            source_link = links.get(connection.get("source"))
+            target_link = links.get(connection.get("target"))
+            if source_link is None or target_link is None:
+                continue
+            source = hostnames.get(source_link.get("node"))
+            target = hostnames.get(target_link.get("node"))
+            if source is None or target is None:
+                continue
 
-            nodes.append(
-                NodeJson(
-                    id=source_node.hostname,
-                    device_id=str(source_device_id)
-                )
-            )
-            nodes.append(
-                NodeJson(
-                    id=target_node.hostname,
-                    device_id=str(target_device_id)
-                )
-            )
+            for hostname in (source, target):
+                if hostname not in nodes:
+                    nodes[hostname] = NodeJson(id=hostname, device_id=str(device_ids.get(hostname)))
+
+            adjacency.setdefault(source, set()).add(target)
+            adjacency.setdefault(target, set()).add(source)
+
+            edge = len(edges)
+            edges.append((source, target))
+            for vlan_id in self.__link_vlan_ids__(source_link) | self.__link_vlan_ids__(target_link):
+                key = (vlan_id, source, target)
+                if key not in seen:
+                    seen.add(key)
+                    vlan_edges.setdefault(vlan_id, []).append(edge)
 
-        tree = TreeJson(links=links, nodes=nodes)
-        return tree
+        return {
+            "topology_version": topology_version,
+            "built": time.monotonic(),
+            "nodes": nodes,
+            "edges": edges,
+            "adjacency": adjacency,
+            "vlan_edges": vlan_edges,
+            "views": {}
+        }
+
+    def __link_vlan_ids__(self, link: dict):
+        vlan_ids = set()
+        for vlan in link.get("vlans", []):
+            # VLANs stored as strings were never matched by the old tree filter either
+            if isinstance(vlan, dict) and "id" in vlan:
+                vlan_ids.add(vlan["id"])
+        return vlan_ids
 
     def __get_node__(self, ip: str = None, hostname: str = None):
         if ip and hostname:
@@ -1202,12 +2335,6 @@ class MongoDBIO:
                 node = Node(hostname=hostname).save()
             else:
                 node = Node(hostname=hostname, ip=ip).save()
-        else:
-            Link.objects.raw(
-                {
-                    "node": node.pk
-                }
-            ).delete()
 
         new_links = []
         for link_key in links:
@@ -1255,9 +2382,29 @@ class MongoDBIO:
                 new_link.vlans = vlans
                 new_link.is_trunk = is_trunk
 
-            new_link = self.__save_link__(new_link)
-            if new_link:
-                new_links.append(new_link)
+            new_links.append(new_link)
+
+        links_hash = self.__content_hash__(sorted(
+            [[link.mac, link.description, link.remote_mac, link.vlans, link.is_trunk] for link in new_links],
+            key=lambda link: str(link)))
+        if node.links_hash == links_hash:
+            self.write_metrics["links_skipped"] += 1
+            return
+
+        Link.objects.raw(
+            {
+                "node": node.pk
+            }
+        ).delete()
+
+        for new_link in new_links:
+            self.__save_link__(new_link)
+
+        Node._mongometa.collection.update_one({"_id": node.pk}, {"$set": {"links_hash": links_hash}})
+        self.write_metrics["links_applied"] += 1
+
+        # Replacing the links of a node cascades to its connections
+        self.__bump_topology_version__()
 
         # for new_link in new_links:
         #     self.__create_connections__(new_link)
@@ -1272,9 +2419,14 @@ class MongoDBIO:
     # --- Redis --- #
 
     def redis_insert_live_data(self, device: Device, live_data: dict):
+        """
+        Buffers the samples for the rollup, keeps the live rings and publishes them for live feeds
+        """
         hostname = device.hostname
         print(live_data)
 
+        pipelines = {}
+        samples = []
         for port in live_data:
             if isinstance(live_data[port], dict) is False:
                 continue
@@ -1293,78 +2445,698 @@ class MongoDBIO:
                     continue
 
                 if database_index != -1:
-                    self.redis_insert(hostname=f"{hostname}--//--{port}", values=port_data[key],
-                                      database_index=database_index)
+                    if database_index not in pipelines:
+                        pipelines[database_index] = self.__get_redis__(database_index).pipeline(transaction=False)
+                    pipelines[database_index].zadd(f"{hostname}--//--{port}", port_data[key])
+
+                    for ts, value in port_data[key].items():
+                        samples.append({"port": port, "counter": key, "time": str(ts), "value": value})
+
+        if samples:
+            # The ring database is not scanned by the rollup, so the rings outlive the sorted sets
+            if self.live_ring_db not in pipelines:
+                pipelines[self.live_ring_db] = self.__get_redis__(self.live_ring_db).pipeline(transaction=False)
+            ring = pipelines[self.live_ring_db]
+            if self.live_ring_size > 0:
+                rings = {}
+                for sample in samples:
+                    rings.setdefault(self.__live_ring_key__(hostname, sample["port"], sample["counter"]), []).append(
+                        json.dumps([sample["time"], sample["value"]]))
+                for ring_key, entries in rings.items():
+                    ring.lpush(ring_key, *entries)
+                    ring.ltrim(ring_key, 0, self.live_ring_size - 1)
+                    ring.expire(ring_key, self.live_ring_ttl)
+                # The ring keys of a device, so that reading them never has to scan the ring database
+                ring.sadd(self.__live_ring_index_key__(hostname), *rings.keys())
+                ring.expire(self.__live_ring_index_key__(hostname), self.live_ring_ttl)
+            ring.publish(LIVE_CHANNEL, json.dumps({"device": hostname, "samples": samples}))
+
+        for pipeline in pipelines.values():
+            self.__execute_pipeline__(pipeline)
+
+    def __live_ring_key__(self, hostname: str, port: str, counter: str):
+        return f"{hostname}--//--{port}--//--{counter}"
+
+    def __live_ring_index_key__(self, hostname: str):
+        return f"{hostname}--//--rings"
+
+    def get_live_ring(self, hostname: str, ports: list = None, counters: list = None):
+        """
+        Returns the buffered samples of a device, oldest first, optionally only of some ports and counters
+        """
+        r = self.__get_redis__(self.live_ring_db)
+        if ports and counters:
+            keys = [self.__live_ring_key__(hostname, port, counter) for port in ports for counter in counters]
+        else:
+            keys = []
+            for key in r.smembers(self.__live_ring_index_key__(hostname)):
+                _, port, counter = str(key, "utf-8").split("--//--")
+                if (not ports or port in ports) and (not counters or counter in counters):
+                    keys.append(self.__live_ring_key__(hostname, port, counter))
+
+        pipeline = r.pipeline(transaction=False)
+        for key in keys:
+            pipeline.lrange(key, 0, -1)
+        samples = []
+        for key, entries in zip(keys, self.__execute_pipeline__(pipeline) if keys else []):
+            _, port, counter = key.split("--//--")
+            for entry in reversed(entries):
+                ts, value = json.loads(entry)
+                samples.append({"port": port, "counter": counter, "time": ts, "value": value})
+        return samples
 
     def redis_insert(self, hostname: str, values: dict, database_index: int):
-        pool = redis.ConnectionPool(host=str(dconfig("rDBurl")),
-                                    port=str(dconfig("rDBport")),
-                                    password=str(dconfig("rDBpassword")),
-                                    username=str(dconfig("rDBusername")),
-                                    db=database_index)
-        r = redis.Redis(connection_pool=pool)
-        r.zadd(hostname, values)
-        pool.connection_class()
+        self.__get_redis__(database_index).zadd(hostname, values)
 
-    async def thread_insertIntoDatabase(self):
-        while True:
-            await asyncio.sleep(30 * 60)
-
-            for i in range(0, len(self.redis_indices)):
+    def __get_redis__(self, database_index: int):
+        with self.redis_lock:
+            if database_index not in self.redis_clients:
                 pool = redis.ConnectionPool(host=str(dconfig("rDBurl")),
                                             port=str(dconfig("rDBport")),
                                             password=str(dconfig("rDBpassword")),
                                             username=str(dconfig("rDBusername")),
-                                            db=i)
-                r = redis.Redis(connection_pool=pool)
+                                            db=database_index)
+                self.redis_clients[database_index] = redis.Redis(connection_pool=pool)
+            return self.redis_clients[database_index]
+
+    def __execute_pipeline__(self, pipeline):
+        size = len(pipeline)
+        result = pipeline.execute()
+
+        self.redis_metrics["pipelines"] += 1
+        self.redis_metrics["pipeline_commands"] += size
+        self.redis_metrics["max_pipeline_size"] = max(self.redis_metrics["max_pipeline_size"], size)
+        return result
+
+    def get_cache_metrics(self):
+        return {
+            "config": self.config_cache.get_metrics(),
+            "category": self.category_cache.get_metrics(),
+            "hostname": self.hostname_cache.get_metrics(),
+            "device_id": self.device_id_cache.get_metrics(),
+            "token": self.token_cache.get_metrics()
+        }
+
+    def get_redis_metrics(self):
+        metrics = dict(self.redis_metrics)
+        connections = 0
+        for client in list(self.redis_clients.values()):
+            connections += client.connection_pool._created_connections
+        metrics["pools"] = len(self.redis_clients)
+        metrics["connections"] = connections
+        return metrics
+
+    def close(self):
+        with self.redis_lock:
+            for client in self.redis_clients.values():
+                client.connection_pool.disconnect()
+            self.redis_clients = {}
+
+    # --- Background jobs --- #
+
+    def __lease_owner__(self):
+        return f"{socket.gethostname()}-{os.getpid()}"
+
+    def acquire_lease(self, name: str, ttl: int = 60):
+        """
+        Takes or renews the lease name for this process, returns False while another process holds it
+        """
+        now = datetime.utcnow()
+        try:
+            Lease._mongometa.collection.update_one(
+                {"_id": name, "$or": [{"owner": self.__lease_owner__()}, {"expires": {"$lt": now}}]},
+                {"$set": {"owner": self.__lease_owner__(), "expires": now + timedelta(seconds=ttl),
+                          "_cls": Lease._mongometa.object_name}},
+                upsert=True)
+            return True
+        except pymongo.errors.DuplicateKeyError:
+            return False
 
-                for key in r.scan_iter():
-                    keys = str(key, "utf-8").split("--//--")
-                    if isinstance(keys, list):
-                        hostname = keys[0]
-                        port = keys[1]
+    def release_lease(self, name: str):
+        Lease._mongometa.collection.delete_one({"_id": name, "owner": self.__lease_owner__()})
 
-                    scores = r.zrange(key, 0, -1, withscores=True)
+    async def run_background_jobs(self, lease_ttl: int = 60):
+        """
+        Runs the background jobs while this process holds the background-jobs lease
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if not await loop.run_in_executor(None, self.acquire_lease, "background-jobs", lease_ttl):
+                await asyncio.sleep(lease_ttl / 3)
+                continue
 
-                    device = self.get_device_by_hostname(hostname)
-                    if isinstance(device, bool) and device is False:
-                        category = self.get_category_by_category("New")
+            print("Background jobs lease acquired")
+            jobs = [asyncio.ensure_future(loop.run_in_executor(None, self.run_backfills)),
+                    asyncio.ensure_future(self.thread_insertIntoDatabase()),
+                    asyncio.ensure_future(self.keep_connections()),
+                    asyncio.ensure_future(self.keep_retention()),
+                    asyncio.ensure_future(self.keep_event_retention())]
+            try:
+                while True:
+                    await asyncio.wait(jobs, timeout=lease_ttl / 3, return_when=asyncio.FIRST_COMPLETED)
+                    for job in jobs:
+                        if job.done():
+                            # Surface the error, main restarts on lost database connections
+                            job.result()
+                    # The backfills run once per lease
+                    jobs = [job for job in jobs if not job.done()]
+                    if not await loop.run_in_executor(None, self.acquire_lease, "background-jobs", lease_ttl):
+                        print("Background jobs lease lost")
+                        break
+            finally:
+                for job in jobs:
+                    job.cancel()
+
+    def run_backfills(self):
+        """
+        Fills collections added by upgrades that are still empty, the CLI commands rerun them on demand
+        """
+        if EventCount._mongometa.collection.find_one({}, {"_id": 1}) is None and \
+                Event._mongometa.collection.find_one({}, {"_id": 1}) is not None:
+            print(f"Rebuilt {self.reconcile_event_counts()} event count buckets")
+
+        stamped = self.stamp_event_expiry()
+        if stamped:
+            print(f"Set the expiry of {stamped} events")
+
+        if SearchEntry._mongometa.collection.find_one({}, {"_id": 1}) is None and \
+                Data._mongometa.collection.find_one({}, {"_id": 1}) is not None:
+            print(f"Indexed {self.rebuild_search_index()} static data values")
+
+        if LiveBucket._mongometa.collection.find_one({}, {"_id": 1}) is None and \
+                Data._mongometa.collection.find_one({"key": {"$in": self.redis_indices}}, {"_id": 1}) is not None:
+            print(f"Moved {self.migrate_live_history()} live data entries into live buckets")
 
-                        if category is None:
-                            category = self.add_category(category="New")
+    async def thread_insertIntoDatabase(self):
+        while True:
+            await asyncio.sleep(self.rollup_interval)
+            await asyncio.get_running_loop().run_in_executor(None, self.insert_live_data_into_database)
+
+    def insert_live_data_into_database(self):
+        """
+        Rolls the samples collected in Redis up into one entry per port and counter
+        """
+        started = time.perf_counter()
+        now = datetime.now().replace(microsecond=0)
+
+        # {hostname: {counter: {port: statistics}}}
+        rollup = {}
+        keys = 0
+        samples = 0
+        for database_index in range(0, len(self.redis_indices)):
+            counter = self.redis_indices[database_index]
+            for hostname, port, statistics in self.__rollup_database__(database_index):
+                rollup.setdefault(hostname, {}).setdefault(counter, {})[port] = statistics
+                keys += 1
+                samples += statistics["count"]
+
+        if rollup:
+            self.__write_rollup__(rollup, now)
+
+        duration = time.perf_counter() - started
+        self.rollup_metrics["runs"] += 1
+        self.rollup_metrics["last_duration"] = duration
+        self.rollup_metrics["max_duration"] = max(self.rollup_metrics["max_duration"], duration)
+        self.rollup_metrics["last_keys"] = keys
+        self.rollup_metrics["last_samples"] = samples
+        self.rollup_metrics["last_devices"] = len(rollup)
+        print(f"Rolled up {samples} samples of {keys} keys for {len(rollup)} devices in {duration:.3f}s")
+        return duration
+
+    def __rollup_database__(self, database_index: int):
+        """
+        Yields (hostname, port, statistics) for every key of a counter database and removes the keys it read
+        """
+        r = self.__get_redis__(database_index)
+
+        # Finish the scan before deleting anything, so the cursor never walks over keys this rollup removed
+        keys = list(r.scan_iter(count=self.rollup_batch_size))
+
+        names = []
+        values = []
+        times = []
+        sizes = []
+        for start in range(0, len(keys), self.rollup_batch_size):
+            self.__read_rollup_batch__(r, keys[start:start + self.rollup_batch_size], names, values, times, sizes)
+
+        if not names:
+            return
 
-                        device = self.add_device(hostname=hostname, category=category)
+        statistics = self.__rollup_statistics__(np.concatenate(values), np.concatenate(times), np.array(sizes))
+        for index, name in enumerate(names):
+            hostname, port = name
+            yield hostname, port, {
+                "min": float(statistics["min"][index]),
+                "max": float(statistics["max"][index]),
+                "mean": float(statistics["mean"][index]),
+                "p95": float(statistics["p95"][index]),
+                "rate": float(statistics["rate"][index]),
+                "count": int(sizes[index])
+            }
+
+    def __read_rollup_batch__(self, r, batch: list, names: list, values: list, times: list, sizes: list):
+        # Read and delete in one MULTI, samples added while the rollup runs stay for the next window
+        pipeline = r.pipeline(transaction=True)
+        for key in batch:
+            pipeline.zrange(key, 0, -1, withscores=True)
+            pipeline.delete(key)
+        result = self.__execute_pipeline__(pipeline)
+
+        for index, key in enumerate(batch):
+            scores = result[index * 2]
+            parts = str(key, "utf-8").split("--//--")
+            if not scores or len(parts) != 2:
+                continue
 
-                    type = self.redis_indices[i]
+            names.append((parts[0], parts[1]))
+            sizes.append(len(scores))
+            values.append(np.fromiter((score[1] for score in scores), dtype=np.float64, count=len(scores)))
+            times.append(self.__sample_times__([score[0] for score in scores]))
 
-                    avg_score = 0
-                    for score in scores:
-                        avg_score += score[1]
-                        #if score[1] >= 10:
-                        if False:
+    def __sample_times__(self, members: list):
+        # Members are the timestamps the aggregator sent, epoch seconds or '%Y-%m-%d %H:%M:%S'
+        try:
+            return np.array(members).astype(np.float64)
+        except ValueError:
+            pass
 
-                            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            event_time = str(score[0], "utf-8")
-                            if self.__is_float__(num=event_time) is True:
-                                timestamp = datetime.fromtimestamp(float(event_time))
-                            elif isinstance(event_time, str):
-                                timestamp = datetime.strptime(event_time, '%Y-%m-%d %H:%M:%S')
+        times = np.full(len(members), np.nan)
+        for index, member in enumerate(members):
+            member = str(member, "utf-8")
+            if self.__is_float__(num=member) is True:
+                times[index] = float(member)
+                continue
+            try:
+                times[index] = datetime.strptime(member, '%Y-%m-%d %H:%M:%S').timestamp()
+            except ValueError:
+                pass
+        return times
+
+    def __rollup_statistics__(self, values, times, sizes):
+        """
+        Computes min, max, mean, p95 and rate per segment of the flat sample arrays
+        """
+        count = len(sizes)
+        segments = np.repeat(np.arange(count), sizes)
+        starts = np.cumsum(sizes) - sizes
+
+        order = np.lexsort((values, segments))
+        ordered = values[order]
+
+        position = starts + 0.95 * (sizes - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+
+        # Rate is the change per second between the oldest and the newest sample with a readable timestamp
+        valid = ~np.isnan(times)
+        valid_segments = segments[valid]
+        valid_sizes = np.bincount(valid_segments, minlength=count)
+        order = np.lexsort((times[valid], valid_segments))
+        valid_times = times[valid][order]
+        valid_values = values[valid][order]
+
+        rates = np.zeros(count)
+        measured = valid_sizes >= 2
+        if measured.any():
+            ends = np.cumsum(valid_sizes)
+            first = (ends - valid_sizes)[measured]
+            last = ends[measured] - 1
+            elapsed = valid_times[last] - valid_times[first]
+            change = valid_values[last] - valid_values[first]
+            rates[measured] = np.divide(change, elapsed, out=np.zeros_like(change), where=elapsed > 0)
+
+        return {
+            "min": ordered[starts],
+            "max": ordered[starts + sizes - 1],
+            "mean": np.bincount(segments, weights=values, minlength=count) / sizes,
+            "p95": ordered[low] + (ordered[high] - ordered[low]) * (position - low),
+            "rate": rates
+        }
+
+    def __write_rollup__(self, rollup: dict, now: datetime):
+        """
+        Writes one rollup window to the LiveBuckets and the live Data documents
+        """
+        timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+        bucket_start = self.__bucket_start__(now)
+
+        projection = {"hostname": 1, "live": 1, "_cls": 1}
+        hostnames = list(rollup)
+        known = self.__find_devices_by_hostnames__(hostnames, projection)
+        if len(known) < len(hostnames):
+            category = self.get_category_by_category("New")
+            if category is None:
+                category = self.add_category(category="New")
+            self.__insert_devices__(hostnames, known, category, projection=projection)
+
+        live_ids = []
+        for document in known.values():
+            live_ids.extend(document.get("live", []))
+
+        live_keys = {}
+        if live_ids:
+            for data in Data._mongometa.collection.find({"_id": {"$in": live_ids}}, {"key": 1}):
+                live_keys[data["_id"]] = data["key"]
+
+        data_operations = []
+        device_operations = []
+        bucket_operations = []
+        for hostname, counters in rollup.items():
+            if hostname not in known:
+                continue
+
+            document = known[hostname]
+            existing = {}
+            for data_id in document.get("live", []):
+                if data_id in live_keys:
+                    existing[live_keys[data_id]] = data_id
+
+            created = []
+            for counter, ports in counters.items():
+                samples = sum(statistics["count"] for statistics in ports.values())
+                mean = sum(statistics["mean"] * statistics["count"] for statistics in ports.values()) / samples
+                stats = self.__clean_dictionary__(ports)
+
+                if counter in existing:
+                    data_operations.append(UpdateOne({"_id": existing[counter]},
+                                                     {"$set": {"data": {timestamp: mean},
+                                                               "stats": {timestamp: stats}}}))
+                else:
+                    data = Data(key=counter, data={timestamp: mean}, stats={timestamp: stats}).to_son()
+                    data["_id"] = ObjectId()
+                    data_operations.append(InsertOne(data))
+                    created.append(data["_id"])
+
+                for port, statistics in ports.items():
+                    bucket_operations.append(self.__bucket_update__(document["_id"], counter, port, bucket_start,
+                                                                    [dict(statistics, time=now)]))
+
+            if created:
+                device_operations.append(UpdateOne({"_id": document["_id"]}, {"$push": {"live": {"$each": created}}}))
+
+        if data_operations:
+            Data._mongometa.collection.bulk_write(data_operations, ordered=False)
+        if device_operations:
+            Device._mongometa.collection.bulk_write(device_operations, ordered=False)
+        if bucket_operations:
+            LiveBucket._mongometa.collection.bulk_write(bucket_operations, ordered=False)
+
+    def __bucket_start__(self, ts: datetime, span: int = None):
+        if span is None:
+            span = self.live_bucket_span
+        return datetime.fromtimestamp(ts.timestamp() // span * span)
+
+    def __bucket_update__(self, device_id: ObjectId, counter: str, port: str, start: datetime, samples: list,
+                          resolution: str = "raw"):
+        update = {"$setOnInsert": {"_cls": LiveBucket._mongometa.object_name}}
+        if resolution == "raw":
+            update["$push"] = {"samples": {"$each": samples}}
+            update["$inc"] = {"count": len(samples)}
+        else:
+            # Compacted points are deterministic, re-running a compaction that stopped before its delete adds no
+            # samples. How many $addToSet added is unknown, __recount_buckets__ sets count afterwards.
+            update["$addToSet"] = {"samples": {"$each": samples}}
+        return UpdateOne({"device": device_id, "counter": counter, "port": port, "resolution": resolution,
+                          "start": start}, update, upsert=True)
+
+    def __recount_buckets__(self, keys: list):
+        """
+        Sets count to the number of samples of the buckets matching keys, [{device, counter, port, resolution, start}]
+        """
+        if not keys:
+            return
+        counts = LiveBucket._mongometa.collection.aggregate([
+            {"$match": {"$or": keys}},
+            {"$project": {"count": {"$size": "$samples"}}}
+        ])
+        operations = [UpdateOne({"_id": bucket["_id"]}, {"$set": {"count": bucket["count"]}}) for bucket in counts]
+        if operations:
+            LiveBucket._mongometa.collection.bulk_write(operations, ordered=False)
+
+    def __retention_tier__(self, start: datetime = None, end: datetime = None):
+        # The finest tier that still holds samples as old as start, an open start reaches back as far as raw
+        # samples are kept before end
+        if start is None and end is not None:
+            start = end - timedelta(seconds=self.retention_tiers[0]["keep"])
+        if start is None:
+            return self.retention_tiers[0]
+        # Whole seconds, an open start computed from end=now stays within the raw tier
+        age = int((datetime.now() - start).total_seconds())
+        for tier in self.retention_tiers:
+            if tier["keep"] is None or age <= tier["keep"]:
+                return tier
+        return self.retention_tiers[-1]
+
+    def get_live_data(self, id: str, counter: str = None, port: str = None, start: datetime = None,
+                      end: datetime = None, step: int = None):
+        """
+        Returns the live counter series of a device between start and end
+        """
+        if not ObjectId.is_valid(id):
+            return False
+        id = ObjectId(id)
+
+        tier = self.__retention_tier__(start, end)
+        tiers = self.retention_tiers[:self.retention_tiers.index(tier) + 1]
+        if tier["step"] and (not step or step < tier["step"]):
+            step = tier["step"]
+
+        query = {"device": id, "resolution": {"$in": [entry["resolution"] for entry in tiers]}}
+        if counter is not None:
+            query["counter"] = counter
+        if port is not None:
+            query["port"] = port
+        if start is not None or end is not None:
+            query["start"] = {}
+            if start is not None:
+                # The bucket holding start began up to one span earlier
+                query["start"]["$gt"] = start - timedelta(seconds=max(entry["span"] for entry in tiers))
+            if end is not None:
+                query["start"]["$lte"] = end
+
+        series = {}
+        buckets = LiveBucket._mongometa.collection.find(query, {"counter": 1, "port": 1, "samples": 1})
+        for bucket in buckets.sort("start", 1):
+            points = series.setdefault((bucket["counter"], bucket["port"]), [])
+            for sample in bucket["samples"]:
+                if start is not None and sample["time"] < start:
+                    continue
+                if end is not None and sample["time"] > end:
+                    continue
+                points.append(sample)
+
+        result = []
+        for (series_counter, series_port), points in sorted(series.items()):
+            if not points:
+                continue
+            points.sort(key=lambda point: point["time"])
+            if step:
+                points = self.__downsample__(points, step)
+            result.append({"counter": series_counter, "port": series_port, "points": points})
+        return result
+
+    def __downsample__(self, points: list, step: int):
+        # points are sorted by time, every step seconds become one point weighted by the sample counts
+        merged = []
+        current = None
+        for point in points:
+            start = datetime.fromtimestamp(point["time"].timestamp() // step * step)
+            count = max(point.get("count", 1), 1)
+            if current is None or current["time"] != start:
+                current = {"time": start, "min": point["min"], "max": point["max"], "mean": 0.0, "p95": point["p95"],
+                           "rate": 0.0, "count": 0}
+                merged.append(current)
+
+            current["min"] = min(current["min"], point["min"])
+            current["max"] = max(current["max"], point["max"])
+            # The exact p95 of the merged samples is unknown, the highest window p95 bounds it from above
+            current["p95"] = max(current["p95"], point["p95"])
+            current["mean"] += point["mean"] * count
+            current["rate"] += point["rate"] * count
+            current["count"] += count
+
+        for point in merged:
+            point["mean"] /= point["count"]
+            point["rate"] /= point["count"]
+        return merged
+
+    def migrate_live_history(self):
+        """
+        Moves the history of live Data documents written before LiveBucket existed into buckets
+        """
+        owners = {}
+        for device in Device._mongometa.collection.find({"live.0": {"$exists": True}}, {"live": 1}):
+            for data_id in device["live"]:
+                owners[data_id] = device["_id"]
+
+        moved = 0
+        data_operations = []
+        bucket_operations = []
+        legacy = Data._mongometa.collection.find({"key": {"$in": self.redis_indices}, "stats": {"$exists": False}},
+                                                 {"key": 1, "data": 1})
+        for data in legacy:
+            if data["_id"] not in owners:
+                continue
+
+            buckets = {}
+            latest = None
+            for timestamp, value in data["data"].items():
+                try:
+                    ts = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                buckets.setdefault(self.__bucket_start__(ts), []).append(
+                    {"time": ts, "min": value, "max": value, "mean": value, "p95": value, "rate": 0.0, "count": 1})
+                if latest is None or timestamp > latest:
+                    latest = timestamp
+
+            for start, samples in buckets.items():
+                bucket_operations.append(self.__bucket_update__(owners[data["_id"]], data["key"], "", start, samples))
+                moved += len(samples)
+
+            update = {"stats": {}}
+            if latest is not None:
+                update["data"] = {latest: data["data"][latest]}
+            data_operations.append(UpdateOne({"_id": data["_id"]}, {"$set": update}))
+
+        if bucket_operations:
+            LiveBucket._mongometa.collection.bulk_write(bucket_operations, ordered=False)
+        if data_operations:
+            Data._mongometa.collection.bulk_write(data_operations, ordered=False)
+        return moved
+
+    def apply_retention(self, dry_run: bool = False, batch_size: int = 500):
+        """
+        Compacts LiveBuckets that aged out of their retention tier into the next tier
+        """
+        now = datetime.now()
+        report = []
+        for source, target in zip(self.retention_tiers, self.retention_tiers[1:]):
+            entry = {"resolution": source["resolution"], "into": target["resolution"], "buckets": 0, "samples": 0,
+                     "points": 0, "bytes_before": 0, "bytes_after": 0}
+            cutoff = now - timedelta(seconds=source["keep"] + source["span"])
+            query = {"resolution": source["resolution"], "start": {"$lte": cutoff}}
+
+            buckets = LiveBucket._mongometa.collection.find(query).batch_size(batch_size)
+            batch = []
+            for bucket in buckets:
+                batch.append(bucket)
+                if len(batch) == batch_size:
+                    self.__compact_buckets__(batch, target, entry, dry_run)
+                    batch = []
+            if batch:
+                self.__compact_buckets__(batch, target, entry, dry_run)
+
+            entry["bytes_reclaimed"] = entry["bytes_before"] - entry["bytes_after"]
+            report.append(entry)
+        return report
+
+    def __compact_buckets__(self, buckets: list, target: dict, entry: dict, dry_run: bool):
+        operations = []
+        keys = []
+        for bucket in buckets:
+            points = self.__downsample__(sorted(bucket["samples"], key=lambda point: point["time"]), target["step"])
+
+            grouped = {}
+            for point in points:
+                grouped.setdefault(self.__bucket_start__(point["time"], target["span"]), []).append(point)
+            for start, samples in grouped.items():
+                operations.append(self.__bucket_update__(bucket["device"], bucket["counter"], bucket["port"], start,
+                                                         samples, resolution=target["resolution"]))
+                keys.append({"device": bucket["device"], "counter": bucket["counter"], "port": bucket["port"],
+                             "resolution": target["resolution"], "start": start})
+
+            entry["buckets"] += 1
+            entry["samples"] += len(bucket["samples"])
+            entry["points"] += len(points)
+            entry["bytes_before"] += len(bson.encode(bucket))
+            entry["bytes_after"] += sum(len(bson.encode(point)) for point in points)
+
+        if dry_run:
+            return
 
-                            event = f"Unusual high amount of {type} at {port}: {str(score[1])}"
-                            self.add_event(device=device, event=event, severity=3, timestamp=timestamp)
+        # Write the compacted points before the sources go, an interrupted run is simply repeated
+        if operations:
+            LiveBucket._mongometa.collection.bulk_write(operations, ordered=False)
+            self.__recount_buckets__(keys)
+        LiveBucket._mongometa.collection.delete_many({"_id": {"$in": [bucket["_id"] for bucket in buckets]}})
 
-                    if len(scores) > 0:
-                        avg_score /= len(scores)
+    def print_retention_report(self, report: list, dry_run: bool = False):
+        for entry in report:
+            print(f"{entry['resolution']} -> {entry['into']}: {entry['buckets']} buckets, {entry['samples']} samples "
+                  f"into {entry['points']} points, {entry['bytes_reclaimed']} bytes "
+                  f"{'reclaimable' if dry_run else 'reclaimed'}")
 
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async def keep_retention(self):
+        while True:
+            await asyncio.sleep(self.retention_interval)
+            report = await asyncio.get_running_loop().run_in_executor(None, self.apply_retention)
+            self.print_retention_report(report)
 
-                    data = {timestamp: avg_score}
-                    self.__handle_live_data__(device=device, key=type, input=data)
-                r.flushdb()
+    def get_rollup_metrics(self):
+        return dict(self.rollup_metrics)
 
     # --- Filter --- #
 
-    def filter_devices(self, key: str, value: str, page: int = None, amount: int = None, category_id: str = None):
+    def filter_devices(self, key: str, value: str, page: int = None, amount: int = None, category_id: str = None,
+                       match: str = "substring"):
+        """
+        Finds devices whose static data at key matches value, answered from the SearchEntry index
+        """
+        self.__handle_filter__(key, value)
+
+        if page and page <= 0:
+            page = None
+
+        if amount and amount <= 0:
+            amount = None
+
+        query = {"key": key}
+        if match == "exact":
+            query["value"] = value.lower()
+        elif match == "prefix":
+            query["value"] = {"$regex": f"^{re.escape(value.lower())}"}
+        else:
+            query["value"] = {"$regex": re.escape(value.lower())}
+
+        device_query = {"_id": {"$in": SearchEntry._mongometa.collection.distinct("device", query)}}
+        if category_id:
+            device_query["category"] = ObjectId(category_id)
+        device_query["_cls"] = Device._mongometa.object_name
+
+        total = Device._mongometa.collection.count_documents(device_query)
+        devices = Device._mongometa.collection.find(device_query, {"hostname": 1, "ip": 1, "category": 1})
+        devices = devices.sort("_id", DESCENDING)
+        if page and amount:
+            devices = devices.skip((page - 1) * amount).limit(amount)
+
+        devs = []
+        for d in devices:
+            if "category" in d:
+                category = self.get_category_by_id(d["category"])
+                if category and isinstance(category, Category) and hasattr(category, "category"):
+                    category = category.category
+                    d["category"] = category
+                else:
+                    d.pop("category")
+
+            d["id"] = str(d.pop("_id"))
+
+            devs.append(d)
+
+        return {
+            "page": page,
+            "amout": amount,
+            "total": total,
+            "devices": devs
+        }
+
+    def filter_devices_legacy(self, key: str, value: str, page: int = None, amount: int = None,
+                              category_id: str = None):
+        """
+        Previous $objectToArray/$regex implementation of filter_devices, kept for benchmark comparisons
+        """
         self.__handle_filter__(key, value)
 
         if page and page <= 0: